@@ -2,8 +2,28 @@ import os
 
 from dotenv import load_dotenv
 
-from flask import Flask
+from flask import Flask, jsonify
 from flask_cors import CORS
+from psycopg_pool import PoolTimeout
+
+from app.cache import TTLCache
+from app.hashing import HashingBusy, PasswordHasher
+from app.utils import TOKEN_LIFETIME
+
+# Shared across requests; bcrypt runs on its process pool
+hasher = PasswordHasher()
+
+# user id -> username for /verify; a token can't outlive its TTL, and usernames
+# only change through invalidate_user
+verify_cache = TTLCache(
+    maxsize=int(os.getenv("VERIFY_CACHE_SIZE", "10000")),
+    ttl=TOKEN_LIFETIME.total_seconds()
+)
+
+
+def invalidate_user(user_id):
+    """Drop a user's cached /verify entry; call after deleting or renaming them"""
+    verify_cache.invalidate(str(user_id))
 
 def create_app(test_config=None):
 
@@ -31,7 +51,19 @@ def create_app(test_config=None):
     
     app.config.from_mapping(
         DATABASE_URL=os.getenv("DATABASE_URL"),
-        JWT_SECRET=os.getenv("JWT_SECRET")
+        JWT_SECRET=os.getenv("JWT_SECRET"),
+        DB_POOL_MIN_SIZE=int(os.getenv("DB_POOL_MIN_SIZE", "2")),
+        DB_POOL_MAX_SIZE=int(os.getenv("DB_POOL_MAX_SIZE", "10")),
+        DB_POOL_TIMEOUT=float(os.getenv("DB_POOL_TIMEOUT", "5")),
+        DB_POOL_MAX_IDLE=float(os.getenv("DB_POOL_MAX_IDLE", "300")),
+        DB_POOL_CHECK_INTERVAL=float(os.getenv("DB_POOL_CHECK_INTERVAL", "60")),
+        BCRYPT_LOG_ROUNDS=int(os.getenv("BCRYPT_LOG_ROUNDS", "12")),
+        HASH_WORKERS=int(os.getenv("HASH_WORKERS", "0")),
+        HASH_QUEUE_SIZE=int(os.getenv("HASH_QUEUE_SIZE", "16")),
+        HASH_RETRY_AFTER=int(os.getenv("HASH_RETRY_AFTER", "1")),
+        PROVISIONING_TOKEN=os.getenv("PROVISIONING_TOKEN"),
+        PROVISIONING_MAX_USERS=int(os.getenv("PROVISIONING_MAX_USERS", "10000")),
+        PROVISIONING_BCRYPT_LOG_ROUNDS=int(os.getenv("PROVISIONING_BCRYPT_LOG_ROUNDS", "8"))
     )
 
     if test_config is None:
@@ -44,7 +76,22 @@ def create_app(test_config=None):
     except OSError:
         pass
 
-    from . import routes
+    from . import database, routes
+
+    database.init_database(app)
+    hasher.init_app(app)
+
+    @app.errorhandler(PoolTimeout)
+    def database_busy(e):
+        return jsonify({"error": "Database busy, please retry"}), 503
+
+    @app.errorhandler(HashingBusy)
+    def hashing_busy(e):
+        return (
+            jsonify({"error": "Too many login attempts in progress, please retry"}),
+            503,
+            {"Retry-After": str(app.config['HASH_RETRY_AFTER'])}
+        )
 
     routes.register_routes(app)
 
@@ -1,14 +1,63 @@
+import threading
+import time
+
 import psycopg
 from flask import g, current_app
+from psycopg.pq import TransactionStatus
+from psycopg_pool import ConnectionPool
+
 def init_database(app):
-    app.teardon_appcontext(close_connection)
+    # One bounded pool per process. Connections run in autocommit mode, so
+    # read-only requests leave nothing to roll back; multi-statement writes
+    # use db.transaction(). Idle connections are health-checked in the
+    # background rather than on every checkout.
+    pool = ConnectionPool(
+        app.config['DATABASE_URL'],
+        min_size=app.config['DB_POOL_MIN_SIZE'],
+        max_size=app.config['DB_POOL_MAX_SIZE'],
+        timeout=app.config['DB_POOL_TIMEOUT'],
+        max_idle=app.config['DB_POOL_MAX_IDLE'],
+        kwargs={"autocommit": True},
+        open=True
+    )
+    app.extensions['db_pool'] = pool
+    _start_pool_checker(pool, app.config['DB_POOL_CHECK_INTERVAL'])
+    app.teardown_appcontext(close_connection)
+
+def _start_pool_checker(pool: ConnectionPool, interval: float):
+    def run():
+        while not pool.closed:
+            time.sleep(interval)
+            try:
+                pool.check()
+            except Exception:
+                pass
+    threading.Thread(target=run, name="db-pool-check", daemon=True).start()
 
-def get_database():
+def get_database() -> psycopg.Connection:
     if 'db' not in g:
-        g.db = psycopg.connect(current_app.config['DATABASE_URL'])
+        g.db = current_app.extensions['db_pool'].getconn()
     return g.db
+
 def close_connection(e=None):
+    """Return the request's connection to the pool; safe to call before the request ends.
+
+    The pool does not health-check on checkout, so a connection that failed
+    (e.g. after a Postgres restart) is closed here and the pool replaces it.
+    """
     db = g.pop('db',None)
-    if db is not None:
+    if db is None:
+        return
+    try:
+        status = db.info.transaction_status
+        if status == TransactionStatus.UNKNOWN:
+            # The server connection is gone; nothing to roll back
+            db.close()
+        elif status != TransactionStatus.IDLE:
+            # Only a transaction left open by an error needs ending here
+            db.rollback()
+    except psycopg.Error:
         db.close()
-
+    finally:
+        # putconn discards closed or broken connections instead of reusing them
+        current_app.extensions['db_pool'].putconn(db)
@@ -0,0 +1,118 @@
+import math
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+import bcrypt
+
+
+class HashingBusy(Exception):
+    """Raised when every hashing slot is taken; callers should retry later"""
+
+
+def available_cpus() -> int:
+    """CPUs this process may actually use: the container's CPU quota if it has
+    one, else the CPUs it is allowed to run on (not the node's core count)"""
+    cpus = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else (os.cpu_count() or 1)
+    try:
+        # cgroup v2: "<quota> <period>" or "max <period>"
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            quota, period = f.read().split()
+        if quota != "max":
+            cpus = min(cpus, math.ceil(int(quota) / int(period)))
+    except (OSError, ValueError):
+        try:
+            # cgroup v1
+            with open("/sys/fs/cgroup/cpu/cpu.cfs_quota_us") as f:
+                quota = int(f.read())
+            with open("/sys/fs/cgroup/cpu/cpu.cfs_period_us") as f:
+                period = int(f.read())
+            if quota > 0:
+                cpus = min(cpus, math.ceil(quota / period))
+        except (OSError, ValueError):
+            pass
+    return max(cpus, 1)
+
+
+def _hash_password(password: bytes, rounds: int) -> str:
+    return bcrypt.hashpw(password, bcrypt.gensalt(rounds)).decode("utf-8")
+
+
+def _check_password(pw_hash: bytes, password: bytes) -> bool:
+    return bcrypt.checkpw(password, pw_hash)
+
+
+class PasswordHasher:
+    """Runs bcrypt on a dedicated process pool so request threads never burn CPU on it.
+
+    At most workers + queue size hashes may be in flight; beyond that requests are
+    rejected straight away with HashingBusy instead of queueing without bound.
+    """
+
+    def __init__(self):
+        self.rounds = 12
+        self.workers = 1
+        self._executor = None
+        self.bulk_rounds = 12
+        self._bulk_executor = None
+        self._slots = None
+
+    def init_app(self, app):
+        self.rounds = app.config['BCRYPT_LOG_ROUNDS']
+        self.bulk_rounds = app.config['PROVISIONING_BCRYPT_LOG_ROUNDS']
+        self.workers = app.config['HASH_WORKERS'] or available_cpus()
+        self._slots = threading.BoundedSemaphore(self.workers + app.config['HASH_QUEUE_SIZE'])
+        # spawn rather than fork: the Flask server is already multi-threaded here
+        self._executor = ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=multiprocessing.get_context("spawn")
+        )
+        # Bulk fixture hashing gets its own pool, so a large provisioning request
+        # never queues ahead of logins in the executor above
+        self._bulk_executor = ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=multiprocessing.get_context("spawn")
+        )
+        app.extensions['password_hasher'] = self
+
+    def _run(self, fn, *args):
+        if not self._slots.acquire(blocking=False):
+            raise HashingBusy()
+        try:
+            return self._executor.submit(fn, *args).result()
+        finally:
+            self._slots.release()
+
+    def hash_many(self, passwords) -> list:
+        """Hash a batch of fixture passwords in parallel on the bulk pool, outside admission control.
+
+        Uses the (cheaper) provisioning cost, and hashes each distinct password
+        once, so users sharing a password also share its hash.
+        """
+        distinct = list(dict.fromkeys(passwords))
+        hashes = dict(zip(distinct, self._bulk_executor.map(
+            _hash_password,
+            [password.encode("utf-8") for password in distinct],
+            [self.bulk_rounds] * len(distinct),
+            chunksize=max(1, len(distinct) // (self.workers * 4))
+        )))
+        return [hashes[password] for password in passwords]
+
+    def check_many(self, pairs) -> list:
+        """Check a batch of (hash, password) pairs in parallel on the bulk pool,
+        each distinct pair once (fixture users often share one hash)"""
+        distinct = list(dict.fromkeys(pairs))
+        results = dict(zip(distinct, self._bulk_executor.map(
+            _check_password,
+            [pw_hash.encode("utf-8") for pw_hash, _ in distinct],
+            [password.encode("utf-8") for _, password in distinct],
+            chunksize=max(1, len(distinct) // (self.workers * 4))
+        )))
+        return [results[pair] for pair in pairs]
+
+    def generate_password_hash(self, password: str) -> str:
+        return self._run(_hash_password, password.encode("utf-8"), self.rounds)
+
+    def check_password_hash(self, pw_hash: str, password: str) -> bool:
+        return self._run(_check_password, pw_hash.encode("utf-8"), password.encode("utf-8"))
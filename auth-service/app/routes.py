@@ -1,12 +1,55 @@
-from flask import request, jsonify
-from app.database import get_database
-from flask_bcrypt import Bcrypt
+from flask import request, jsonify, current_app
+from app.database import close_connection, get_database
+from app import hasher, verify_cache
 from app.utils import generate_jwt
+import hmac
 import re
 import os
 
 POD_NAME = os.getenv("POD_NAME","unknown")
 
+USERNAME_PATTERN = re.compile(r'^[a-zA-Z0-9_]{3,20}$')
+
+def insert_users(users):
+    """Hash passwords in parallel and load the users in one transaction.
+
+    Rows are COPYed into a temp table and merged with ON CONFLICT DO NOTHING,
+    so existing usernames are skipped. Returns {username: id} for the users
+    actually created.
+    """
+    # Hash before taking a connection; a large batch hashes for minutes
+    hashes = hasher.hash_many([password for _, password in users])
+    db = get_database()
+    with db.transaction():
+        cursor = db.cursor()
+        cursor.execute(
+            "CREATE TEMP TABLE new_users (username VARCHAR(255), password_hash TEXT) ON COMMIT DROP"
+        )
+        with cursor.copy("COPY new_users (username, password_hash) FROM STDIN") as copy:
+            for (username, _), password_hash in zip(users, hashes):
+                copy.write_row((username, password_hash))
+        cursor.execute(
+            "INSERT INTO users (username, password_hash) "
+            "SELECT username, password_hash FROM new_users ON CONFLICT (username) DO NOTHING "
+            "RETURNING username, id"
+        )
+        return dict(cursor.fetchall())
+
+def verify_existing_users(users):
+    """Return {username: id} for the given (username, password) pairs whose
+    account exists and whose password matches"""
+    cursor = get_database().cursor()
+    cursor.execute(
+        "SELECT username, id, password_hash FROM users WHERE username = ANY(%s)",
+        ([username for username, _ in users],)
+    )
+    accounts = {username: (user_id, pw_hash) for username, user_id, pw_hash in cursor.fetchall()}
+    # Give the connection back before checking hashes, as /login does
+    close_connection()
+    candidates = [(username, password) for username, password in users if username in accounts]
+    matches = hasher.check_many([(accounts[username][1], password) for username, password in candidates])
+    return {username: accounts[username][0] for (username, _), ok in zip(candidates, matches) if ok}
+
 def register_routes(app):
 
     @app.route("/")
@@ -17,7 +60,8 @@ def register_routes(app):
     @app.route('/health')
     def health():
         print(f"User connected to endpoint: '/health' in Pod:{POD_NAME}")
-        return jsonify({"service": "auth-service", "status": "running","health":"healthy","pod_instance":POD_NAME})
+        return jsonify({"service": "auth-service", "status": "running","health":"healthy","pod_instance":POD_NAME,
+                        "verify_cache": verify_cache.stats()})
 
     @app.route('/register', methods=['POST'])
     def register():
@@ -30,7 +74,7 @@ def register_routes(app):
             return jsonify({"error": "Username and password are required"}), 400
         
         # Username validation: 3-20 chars, alphanumeric and underscore only
-        if not re.match(r'^[a-zA-Z0-9_]{3,20}$', username):
+        if not USERNAME_PATTERN.match(username):
             return jsonify({"error": "Username must be 3-20 characters, alphanumeric and underscore only"}), 400
         
         # Password validation: minimum 6 characters
@@ -42,7 +86,6 @@ def register_routes(app):
         if password.lower() in weak_passwords:
             return jsonify({"error": "Password is too weak, please choose a stronger password"}), 400
 
-        bcrypt = Bcrypt(app)
         db = get_database()
         cursor = db.cursor()
 
@@ -53,18 +96,22 @@ def register_routes(app):
         if existing_user:
             return jsonify({"error": "Username already exists"}), 409
         
+        # Give the connection back while bcrypt runs so hashing can't drain the pool.
+        # Hash outside the try so a full hashing pool surfaces as 503, not 500
+        close_connection()
+        password_hash = hasher.generate_password_hash(password)
+
         # Create new user
         try:
-            password_hash = bcrypt.generate_password_hash(password).decode("utf-8")
+            cursor = get_database().cursor()
             cursor.execute(
                 "INSERT INTO users (username, password_hash) VALUES (%s, %s) RETURNING id",
                 (username, password_hash)
             )
             user_id = cursor.fetchone()[0]
-            db.commit()
             
             # Generate JWT token for immediate login
-            token = generate_jwt(user_id)
+            token = generate_jwt(user_id, username)
             
             return jsonify({
                 "message": "User registered successfully",
@@ -72,7 +119,6 @@ def register_routes(app):
                 "username": username
             }), 201
         except Exception as e:
-            db.rollback()
             return jsonify({"error": "Registration failed", "details": str(e)}), 500
 
     @app.route('/login', methods=['POST'])
@@ -84,18 +130,18 @@ def register_routes(app):
         if not username or not password:
             return jsonify({"error": "Username and password are required"}), 400
 
-        bcrypt = Bcrypt(app)
-
         sql = "SELECT id,password_hash FROM users WHERE username = %s"
 
         db = get_database()
         cursor = db.cursor()
         cursor.execute(sql,(username,))    
         res = cursor.fetchone()
+        # Give the connection back while bcrypt runs so hashing can't drain the pool
+        close_connection()
         if not res:
             return jsonify({"error":"User not found"}), 404
-        elif bcrypt.check_password_hash(res[1], password):
-            token = generate_jwt(res[0])
+        elif hasher.check_password_hash(res[1], password):
+            token = generate_jwt(res[0], username)
             return jsonify({
                 "access_token": token,
                 "username": username
@@ -118,19 +164,22 @@ def register_routes(app):
             payload = jwt.decode(token, current_app.config['JWT_SECRET'], algorithms=['HS256'])
             user_id = payload['sub']
             
-            db = get_database()
-            cursor = db.cursor()
-            cursor.execute("SELECT username FROM users WHERE id = %s", (user_id,))
-            result = cursor.fetchone()
+            username = verify_cache.get(str(user_id))
+            if username is None:
+                db = get_database()
+                cursor = db.cursor()
+                cursor.execute("SELECT username FROM users WHERE id = %s", (user_id,))
+                result = cursor.fetchone()
+                if not result:
+                    return jsonify({"error": "User not found"}), 404
+                username = result[0]
+                verify_cache.set(str(user_id), username)
             
-            if result:
-                return jsonify({
-                    "valid": True,
-                    "user_id": user_id,
-                    "username": result[0]
-                }), 200
-            else:
-                return jsonify({"error": "User not found"}), 404
+            return jsonify({
+                "valid": True,
+                "user_id": user_id,
+                "username": username
+            }), 200
         except jwt.ExpiredSignatureError:
             return jsonify({"error": "Token has expired"}), 401
         except jwt.InvalidTokenError:
@@ -138,7 +187,6 @@ def register_routes(app):
     
     @app.route('/generate_db')
     def generate_db():
-        bcrypt = Bcrypt(app)
         db = get_database()
         cursor = db.cursor()
         cursor.execute("""
@@ -148,7 +196,6 @@ def register_routes(app):
             password_hash TEXT NOT NULL
         );
         """)
-        db.commit()
         users = [
             ("alice", "pass123"),
             ("bob", "qwerty123"),
@@ -156,11 +203,62 @@ def register_routes(app):
             ("dave", "abc123def"),
             ("emma", "secret123")
         ]
-        for u,p in users:
-            hash = bcrypt.generate_password_hash(p).decode("utf-8")
-            cursor.execute(
-                "INSERT INTO users (username, password_hash) VALUES (%s, %s) ON CONFLICT (username) DO NOTHING", 
-                (u, hash)
-            )
-        db.commit()
-        return jsonify({"message": "Database initialized successfully"})
\ No newline at end of file
+        close_connection()
+        insert_users(users)
+        return jsonify({"message": "Database initialized successfully"})
+
+    @app.route('/users/bulk', methods=['POST'])
+    def provision_users():
+        """Create many users at once and return a pre-issued token for each.
+
+        Meant for load-test fixtures, so it is disabled unless PROVISIONING_TOKEN
+        is set and sent back in the X-Provisioning-Token header. Body is either
+        {"users": [{"username", "password"}, ...]} or
+        {"count": N, "prefix": "lt_", "password": "..."} to generate usernames.
+        Existing usernames are left alone; they get a token only if the given
+        password matches, and are listed under "skipped" otherwise.
+        """
+        expected = current_app.config['PROVISIONING_TOKEN']
+        offered = request.headers.get('X-Provisioning-Token', '')
+        if not expected or not hmac.compare_digest(offered.encode("utf-8"), expected.encode("utf-8")):
+            return jsonify({"error": "Provisioning is not enabled"}), 403
+
+        data = request.get_json(silent=True)
+        if not isinstance(data, dict):
+            return jsonify({"error": "Expected a JSON object body"}), 400
+        if "users" in data:
+            if not isinstance(data['users'], list) or not all(isinstance(u, dict) for u in data['users']):
+                return jsonify({"error": "users must be a list of {username, password} objects"}), 400
+            users = [(str(u.get('username', '')), str(u.get('password', ''))) for u in data['users']]
+        else:
+            count = data.get('count', 0)
+            if not isinstance(count, int) or isinstance(count, bool) or count < 0:
+                return jsonify({"error": "count must be a non-negative integer"}), 400
+            prefix = str(data.get('prefix', 'lt_'))
+            password = str(data.get('password', ''))
+            width = len(str(max(count - 1, 0)))
+            users = [(f"{prefix}{i:0{width}d}", password) for i in range(count)]
+
+        if not users:
+            return jsonify({"error": "No users requested"}), 400
+        if len(users) > current_app.config['PROVISIONING_MAX_USERS']:
+            return jsonify({"error": f"At most {current_app.config['PROVISIONING_MAX_USERS']} users per request"}), 400
+        invalid = [u for u, p in users if not USERNAME_PATTERN.match(u) or len(p) < 6]
+        if invalid:
+            return jsonify({"error": "Invalid username or password", "usernames": invalid[:20]}), 400
+
+        ids = insert_users(users)
+        # Existing accounts only get a token if the supplied password is theirs;
+        # otherwise this endpoint could impersonate any real user
+        existing = [(username, password) for username, password in users if username not in ids]
+        if existing:
+            ids.update(verify_existing_users(existing))
+        tokens = [
+            {"username": username, "user_id": user_id, "access_token": generate_jwt(user_id, username)}
+            for username, user_id in ids.items()
+        ]
+        skipped = [username for username, _ in users if username not in ids]
+        # Saved as-is, this is the file load-test-scenarios.js reads via TOKENS_FILE
+        return jsonify({"provisioned": len(tokens), "users": tokens, "skipped": skipped}), 201, {
+            "Content-Disposition": "attachment; filename=loadtest-users.json"
+        }
\ No newline at end of file
@@ -1,9 +1,16 @@
 import jwt, datetime
 from flask import current_app
-def generate_jwt(userid):
+
+TOKEN_LIFETIME = datetime.timedelta(hours=1)
+
+def generate_jwt(userid, username):
+    now = datetime.datetime.now(datetime.timezone.utc)
+    # username is embedded so the chat backend can verify identity without a lookup
     payload = {
         "sub": userid,
-        "exp": datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(hours=1)
+        "username": username,
+        "iat": now,
+        "exp": now + TOKEN_LIFETIME
     }
     token = jwt.encode(payload,current_app.config['JWT_SECRET'])
     return token
\ No newline at end of file
@@ -0,0 +1,46 @@
+"""Measure bcrypt throughput per core at different work factors.
+
+Usage: python bench_hashing.py [rounds ...] [--workers N] [--count N]
+
+Reports logins (checkpw calls) per second overall and per core, which is
+what sizes HASH_WORKERS and BCRYPT_LOG_ROUNDS for a given pod CPU request.
+"""
+import argparse
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import bcrypt
+
+PASSWORD = b"benchmark-password"
+
+
+def _check(pw_hash: bytes) -> bool:
+    return bcrypt.checkpw(PASSWORD, pw_hash)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("rounds", nargs="*", type=int, default=[10, 11, 12, 13])
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--count", type=int, default=0,
+                        help="checks per work factor (default: 8 per worker)")
+    args = parser.parse_args()
+    count = args.count or args.workers * 8
+
+    print(f"{'rounds':>6} {'ms/login':>9} {'logins/s':>9} {'logins/s/core':>14}")
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        # Warm the pool so process start-up isn't measured
+        list(executor.map(_check, [bcrypt.hashpw(PASSWORD, bcrypt.gensalt(4))] * args.workers))
+        for rounds in args.rounds:
+            pw_hash = bcrypt.hashpw(PASSWORD, bcrypt.gensalt(rounds))
+            start = time.perf_counter()
+            list(executor.map(_check, [pw_hash] * count))
+            elapsed = time.perf_counter() - start
+            per_second = count / elapsed
+            print(f"{rounds:>6} {elapsed / count * args.workers * 1000:>9.1f} "
+                  f"{per_second:>9.1f} {per_second / args.workers:>14.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+import hmac
+import os
+import time
+from typing import Optional
+
+import jwt
+
+from cache import TTLCache
+
+# Shared with the auth service, which signs tokens with the same secret
+JWT_SECRET = os.getenv("JWT_SECRET")
+JWT_ALGORITHMS = ["HS256"]
+
+# Close code for an invalid or expired token. Sent after accepting, since a
+# refused handshake reaches the browser as a bare 1006. Clients should drop
+# the token instead of retrying with it.
+UNAUTHORIZED_CLOSE_CODE = 4401
+# Close code for a connection without a token while REQUIRE_AUTH is on; retrying
+# cannot succeed until the user logs in, so clients should stop reconnecting
+AUTH_REQUIRED_CLOSE_CODE = 4403
+
+# When set, connections without a valid token are refused
+REQUIRE_AUTH = os.getenv("REQUIRE_AUTH", "false").lower() == "true"
+
+# Shared secret for operator-only endpoints; when unset those endpoints are disabled
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+
+_token_cache = TTLCache(
+    maxsize=int(os.getenv("TOKEN_CACHE_SIZE", "10000")),
+    ttl=float(os.getenv("TOKEN_CACHE_TTL", "300"))
+)
+
+
+def verify_token(token: str) -> Optional[dict]:
+    """Check a JWT's signature and expiry in-process and return its claims.
+    
+    Returns None for invalid or expired tokens. Valid claims are cached until
+    the token expires (or the cache TTL, whichever comes first).
+    """
+    claims = _token_cache.get(token)
+    if claims is not None:
+        if claims["exp"] > time.time():
+            return claims
+        _token_cache.pop(token)
+        return None
+    
+    if not JWT_SECRET:
+        return None
+    try:
+        # Tokens issued before the username claim existed can't identify the user locally
+        claims = jwt.decode(token, JWT_SECRET, algorithms=JWT_ALGORITHMS,
+                            options={"require": ["exp", "username"]})
+    except jwt.InvalidTokenError:
+        return None
+    if not claims["username"]:
+        return None
+    
+    _token_cache.set(token, claims, ttl=min(_token_cache.ttl, claims["exp"] - time.time()))
+    return claims
+
+
+def is_admin(token: Optional[str]) -> bool:
+    return bool(ADMIN_TOKEN and token and hmac.compare_digest(token, ADMIN_TOKEN))
@@ -0,0 +1,130 @@
+import atexit
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import time
+from datetime import datetime, timezone
+from typing import Dict, Optional
+
+import orjson
+
+# High-volume events are sampled by default; everything else is always logged
+DEFAULT_SAMPLE_RATES = {
+    "redis.publish": 0.01,
+    "redis.receive": 0.01,
+    "mongo.insert": 0.01,
+    "chat.message": 0.01,
+}
+
+_listener: Optional[logging.handlers.QueueListener] = None
+
+
+def _parse_sample_rates(spec: str) -> Dict[str, float]:
+    """Parse "event=rate,event=rate" as used by LOG_SAMPLE_RATES"""
+    rates = {}
+    for item in spec.split(","):
+        if "=" in item:
+            event, rate = item.split("=", 1)
+            rates[event.strip()] = float(rate)
+    return rates
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line; formatting runs on the listener thread"""
+    
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        event = getattr(record, "event", None)
+        if event:
+            entry["event"] = event
+        entry.update(getattr(record, "fields", None) or {})
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return orjson.dumps(entry, default=str).decode("utf-8")
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that never blocks: records are dropped when the queue is full"""
+    
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+    
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Leave formatting to the listener thread; only freeze the message text
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+    
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class EventLimiter:
+    """Per-event sampling plus a per-second cap on how many records get through"""
+    
+    def __init__(self, sample_rates: Dict[str, float], rate_cap: int):
+        self.sample_rates = sample_rates
+        self.rate_cap = rate_cap
+        self._windows: Dict[str, list] = {}
+        self.suppressed = 0
+    
+    def allow(self, event: str) -> bool:
+        rate = self.sample_rates.get(event, 1.0)
+        if rate < 1.0 and random.random() >= rate:
+            self.suppressed += 1
+            return False
+        if self.rate_cap <= 0:
+            return True
+        now = int(time.monotonic())
+        window = self._windows.get(event)
+        if window is None or window[0] != now:
+            window = self._windows[event] = [now, 0]
+        if window[1] >= self.rate_cap:
+            self.suppressed += 1
+            return False
+        window[1] += 1
+        return True
+
+
+_limiter = EventLimiter(
+    {**DEFAULT_SAMPLE_RATES, **_parse_sample_rates(os.getenv("LOG_SAMPLE_RATES", ""))},
+    int(os.getenv("LOG_EVENT_RATE_CAP", "100"))
+)
+
+
+def configure_logging(level: Optional[str] = None):
+    """Route all logging through a bounded queue drained by a background thread"""
+    global _listener
+    if _listener is not None:
+        return
+    
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(JsonFormatter())
+    
+    log_queue: queue.Queue = queue.Queue(maxsize=int(os.getenv("LOG_QUEUE_SIZE", "10000")))
+    root = logging.getLogger()
+    root.handlers = [DroppingQueueHandler(log_queue)]
+    root.setLevel(level or os.getenv("LOG_LEVEL", "INFO"))
+    
+    _listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    _listener.start()
+    atexit.register(_listener.stop)
+
+
+def log_event(logger: logging.Logger, event: str, msg: str, level: int = logging.INFO, **fields):
+    """Log a named event, subject to its sampling rate and the per-event rate cap"""
+    if not logger.isEnabledFor(level) or not _limiter.allow(event):
+        return
+    logger.log(level, msg, extra={"event": event, "fields": fields})
@@ -1,15 +1,33 @@
 import asyncio
 import os  
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect
+import random
+import signal
+from bson import ObjectId
+from fastapi import FastAPI, Header, HTTPException, Response, WebSocket, WebSocketDisconnect, status
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse
 from mongodb_manager import mongodb_manager
-from redis_manager import RedisManager
+from pydantic import BaseModel, Field
+from pymongo.errors import DuplicateKeyError
+from redis_manager import RedisManager, RECENT_MESSAGES_LIMIT, encode_message
+from prometheus_client import CONTENT_TYPE_LATEST
+import metrics
+import auth
+import outbound
+from outbound import ClientWriter
+import wire
+import workers
+import rate_limit
+from rooms import ROOMS_CHANNEL, RoomRegistry
+from rate_limit import TokenBucket
+from logging_setup import configure_logging, log_event
+import orjson
 import uuid
-from datetime import datetime
-from typing import Dict
+from datetime import datetime, timezone
+from typing import Dict, Optional, Set
 import logging
 
-logging.basicConfig(level=logging.INFO)
+configure_logging()
 logger = logging.getLogger(__name__)
 
 app = FastAPI(title="Chat WebSocket Microservice")
@@ -31,10 +49,21 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-ROOMS = ["general", "python", "devops", "random"]
+HISTORY_PAGE_MAX = 100
+PRESENCE_HEARTBEAT_INTERVAL = int(os.getenv("PRESENCE_HEARTBEAT_INTERVAL", "10"))
+
+# Draining on SIGTERM: fail /health first so the ingress stops routing here, then
+# close sockets in paced batches, each with its own jittered reconnect hint
+DRAIN_READINESS_DELAY = float(os.getenv("DRAIN_READINESS_DELAY", "5"))
+DRAIN_BATCH_SIZE = int(os.getenv("DRAIN_BATCH_SIZE", "200"))
+DRAIN_BATCH_INTERVAL = float(os.getenv("DRAIN_BATCH_INTERVAL", "0.25"))
+DRAIN_RECONNECT_JITTER_MS = int(os.getenv("DRAIN_RECONNECT_JITTER_MS", "10000"))
+# 1012 Service Restart: the client should come back, just not here and not all at once
+DRAIN_CLOSE_CODE = 1012
 
 # Initialize managers
 redis_manager = RedisManager()
+room_registry = RoomRegistry(redis_manager)
 
 @app.on_event("startup")
 async def startup_event():
@@ -44,136 +73,340 @@ async def startup_event():
     # Connect to Redis
     await redis_manager.connect()
     
-    # Ensure default rooms exist
-    await ensure_default_rooms()
+    # Ensure default rooms exist, then keep every room in memory
+    await room_registry.seed_defaults()
+    await room_registry.load()
+    redis_manager.add_control_channel(ROOMS_CHANNEL, room_registry.handle_change)
+    asyncio.create_task(room_registry.refresh_periodically())
+    
+    # Indexes for history range reads and user lookups
+    await mongodb_manager.ensure_indexes()
+    
+    # Start batching message writes to MongoDB
+    mongodb_manager.start_writer()
+    
+    # Process-level gauges and the event-loop lag probe
+    metrics.gauge_function(metrics.WRITE_QUEUE_DEPTH, mongodb_manager.write_queue_depth)
+    metrics.gauge_function(metrics.ACTIVE_CONNECTIONS, lambda: len(manager.active_connections))
+    metrics.gauge_function(outbound.QUEUED_FRAMES, lambda: sum(w.depth() for w in manager.writers.values()))
+    asyncio.create_task(metrics.sample_gauges())
+    asyncio.create_task(metrics.monitor_event_loop_lag())
     
-    # Start Redis subscribers
-    asyncio.create_task(start_redis_subscribers())
+    # Refresh presence entries so crashed pods' users expire on their own
+    asyncio.create_task(presence_heartbeat())
+    
+    # Rebuild room counters that are missing in Redis (e.g. after a Redis flush)
+    asyncio.create_task(reconcile_room_stats(room_registry.ids()))
+    
+    # Drain instead of cutting every socket at once when the pod is replaced;
+    # this replaces uvicorn's own SIGTERM handler, which we hand over to afterwards
+    try:
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, begin_drain)
+    except (NotImplementedError, RuntimeError):
+        logger.warning("⚠️  SIGTERM drain handler not installed (not running on the main thread)")
+    
+    # Start the shared Redis subscriber; rooms are subscribed as local clients join
+    asyncio.create_task(redis_manager.run_subscriber(handle_redis_message))
+    if redis_manager.streams:
+        # Chat messages arrive through the room streams; pub/sub still carries
+        # the ephemeral join/leave notices
+        asyncio.create_task(redis_manager.run_stream_reader(handle_redis_message))
     
     logger.info("✅ All services connected and ready!")
 
-async def ensure_default_rooms():
-    """Ensure default rooms exist in MongoDB"""
-    default_rooms = [
-        {"_id": "general", "name": "General Chat", "description": "Main discussion room"},
-        {"_id": "python", "name": "Python Programming", "description": "Python-related discussions"},
-        {"_id": "devops", "name": "DevOps & Cloud", "description": "Cloud infrastructure and DevOps"},
-        {"_id": "random", "name": "Random Discussions", "description": "Off-topic conversations"}
-    ]
-    
-    for room in default_rooms:
-        existing_room = await mongodb_manager.get_room(room["_id"])
-        if not existing_room:
-            await mongodb_manager.db.rooms.insert_one(room)
-            logger.info(f"✅ Created room: {room['name']}")
+@app.on_event("shutdown")
+async def shutdown_event():
+    # Flush buffered messages before the connections go away
+    await mongodb_manager.stop_writer()
+    await redis_manager.disconnect()
+    await mongodb_manager.disconnect()
 
-async def start_redis_subscribers():
-    rooms = ["general", "python", "devops", "random"]
-    for room in rooms:
-        asyncio.create_task(
-            redis_manager.subscribe_to_room(room, handle_redis_message)
-        )
-        logger.info(f"🔄 Started Redis subscriber for: {room}")
+def drain_close_reason() -> str:
+    # The reason carries a jittered reconnect hint; fits well inside the 123-byte close reason limit
+    return '{"reconnect_after_ms":' + str(random.randint(0, DRAIN_RECONNECT_JITTER_MS)) + '}'
+
+def begin_drain():
+    if not manager.draining:
+        manager.draining = True
+        asyncio.create_task(drain_and_exit())
+
+async def drain_and_exit():
+    logger.info(f"🚰 SIGTERM received - draining {len(manager.active_connections)} connection(s)")
+    try:
+        # Give readiness probes time to see /health fail before sockets start closing
+        await asyncio.sleep(DRAIN_READINESS_DELAY)
+        await manager.drain()
+        # Persist everything the closed connections sent
+        await mongodb_manager.stop_writer()
+    except Exception as e:
+        logger.error(f"Drain failed: {e}")
+    logger.info("✅ Drain complete - shutting down")
+    # uvicorn still handles SIGINT; let it run the normal shutdown from here
+    signal.raise_signal(signal.SIGINT)
 
-async def handle_redis_message(message: dict):
-    room_id = message.get("room_id")
-    if room_id:
-        await manager._broadcast_to_room(room_id, message)
+async def presence_heartbeat():
+    """Keep this process's users alive in the room presence sets"""
+    while True:
+        await asyncio.sleep(PRESENCE_HEARTBEAT_INTERVAL)
+        try:
+            await redis_manager.heartbeat_presence(manager.presence_by_room())
+        except Exception as e:
+            logger.error(f"Presence heartbeat failed: {e}")
+
+async def reconcile_room_stats(room_ids: list, force: bool = False) -> list:
+    """Rebuild Redis room counters from MongoDB, by default only where they were lost"""
+    start_of_day = datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+    since = int(start_of_day.timestamp() * 1000)
+    reconciled = []
+    for room_id in room_ids:
+        if not force and await redis_manager.has_room_stats(room_id):
+            continue
+        # Held by another worker or pod rebuilding the same room
+        lock_token = await redis_manager.lock_room_stats(room_id)
+        if lock_token is None:
+            continue
+        try:
+            # The holder before us may have just finished this room
+            if not force and await redis_manager.has_room_stats(room_id):
+                continue
+            # Read before counting MongoDB so messages sent during the rebuild are
+            # applied as a delta instead of being overwritten
+            baseline = await redis_manager.get_room_message_count(room_id)
+            # Messages still in the write-behind queue are not counted yet; the
+            # error is bounded by the queue depth and only affects this rebuild
+            message_count = await mongodb_manager.get_room_messages_count(room_id)
+            posters_today = await mongodb_manager.get_room_posters_since(room_id, since)
+            if await redis_manager.reset_room_stats(room_id, message_count, posters_today, baseline, lock_token):
+                reconciled.append(room_id)
+        finally:
+            await redis_manager.unlock_room_stats(room_id, lock_token)
+    if reconciled:
+        logger.info(f"Reconciled room stats from MongoDB: {', '.join(reconciled)}")
+    return reconciled
+
+async def handle_redis_message(room_id: str, payload: str):
+    # The room id comes from the channel name, so the payload is never parsed
+    await manager._broadcast_to_room(room_id, payload)
+    metrics.observe_delivery(payload)
+
+def build_history_snapshot(room_id: str, payloads: list, resumed: bool = False) -> str:
+    """Wrap already-encoded messages in one history frame without re-encoding them"""
+    return (
+        '{"type":"history","room_id":' + orjson.dumps(room_id).decode("utf-8")
+        + (',"resumed":true' if resumed else '')
+        + ',"messages":[' + ",".join(payloads) + ']}'
+    )
+
+# Pre-encoded so rejecting a flood costs no serialization
+RATE_LIMITED_FRAMES = {
+    scope: encode_message({
+        "type": "rate_limited",
+        "scope": scope,
+        "username": "System",
+        "content": "You are sending messages too fast"
+    })
+    for scope in ("client", "cluster")
+}
 
 class ConnectionManager:
     def __init__(self):
         self.active_connections: Dict[str, WebSocket] = {}
         self.user_rooms: Dict[str, str] = {}
         self.usernames: Dict[str, str] = {}
+        # Room -> client ids index so fan-out only touches the room's members
+        self.room_members: Dict[str, Set[str]] = {}
+        # Each connection's writes go through its own bounded queue and task
+        self.writers: Dict[str, ClientWriter] = {}
+        # Local admission control, one bucket per connection
+        self.rate_limiters: Dict[str, TokenBucket] = {}
+        # Usernames taken from a verified JWT at the handshake
+        self.authenticated_users: Dict[str, str] = {}
+        # Set on SIGTERM; new connections are refused while existing ones are closed
+        self.draining = False
     
-    async def connect(self, websocket: WebSocket, client_id: str):
-        await websocket.accept()
+    def _add_to_room(self, client_id: str, room_id: str):
+        self.room_members.setdefault(room_id, set()).add(client_id)
+    
+    def _remove_from_room(self, client_id: str, room_id: str):
+        members = self.room_members.get(room_id)
+        if members is not None:
+            members.discard(client_id)
+            if not members:
+                del self.room_members[room_id]
+                # Last local member left - stop receiving the room's traffic
+                redis_manager.unsubscribe_room(room_id)
+    
+    def _publish_leave(self, room_id: str, username: str):
+        """Broadcast a leave delta once the user has no other local connection in the room"""
+        if self.draining:
+            # Everyone here is about to reconnect elsewhere; announcing each leave
+            # would be O(members^2) frames per room, and presence expires by TTL
+            return
+        if any(self.usernames.get(other) == username for other in self.room_members.get(room_id, ())):
+            return
+        leave_message = {
+            "id": str(uuid.uuid4()),
+            "username": "System",
+            "content": f"{username} left the chat",
+            "timestamp": int(datetime.now().timestamp() * 1000),
+            "room_id": room_id,
+            "left": username
+        }
+        asyncio.create_task(redis_manager.publish_message(room_id, leave_message))
+        asyncio.create_task(redis_manager.remove_online_user(room_id, username))
+    
+    def presence_by_room(self) -> Dict[str, Set[str]]:
+        """Usernames connected to this process, grouped by room"""
+        return {
+            room_id: {self.usernames[client_id] for client_id in members if client_id in self.usernames}
+            for room_id, members in self.room_members.items()
+        }
+    
+    async def connect(self, websocket: WebSocket, client_id: str, username: Optional[str] = None):
+        subprotocol = wire.negotiate_subprotocol(websocket)
+        await websocket.accept(subprotocol=subprotocol)
+        if username:
+            self.authenticated_users[client_id] = username
+        else:
+            self.authenticated_users.pop(client_id, None)
+        # A reused client id must not keep receiving for its previous room
+        previous_room = self.user_rooms.pop(client_id, None)
+        if previous_room:
+            self._remove_from_room(client_id, previous_room)
+        previous_writer = self.writers.pop(client_id, None)
+        if previous_writer:
+            previous_writer.stop()
         self.active_connections[client_id] = websocket
-        logger.info(f"Client {client_id} connected on Pod: {POD_NAME}")
+        workers.report_connections(len(self.active_connections))
+        self.rate_limiters[client_id] = TokenBucket(rate_limit.CLIENT_RATE, rate_limit.CLIENT_BURST)
+        self.writers[client_id] = ClientWriter(
+            client_id, websocket, on_evict=self.disconnect,
+            binary=subprotocol == wire.MSGPACK_SUBPROTOCOL
+        )
+        log_event(logger, "ws.connect", f"Client {client_id} connected on Pod: {POD_NAME}")
     
-    def disconnect(self, client_id: str):
-        if client_id in self.active_connections:
+    def disconnect(self, client_id: str, websocket: WebSocket):
+        # Clients reuse their id on reconnect; a stale socket noticed late must
+        # not tear down the session that replaced it
+        if self.active_connections.get(client_id) is websocket:
             room_id = self.user_rooms.get(client_id)
             username = self.usernames.get(client_id)
             
-            if room_id and username:
-                # Notify others via Redis
-                leave_message = {
-                    "id": str(uuid.uuid4()),
-                    "username": "System",
-                    "content": f"{username} left the chat",
-                    "timestamp": int(datetime.now().timestamp() * 1000),
-                    "room_id": room_id
-                }
-                asyncio.create_task(redis_manager.publish_message(room_id, leave_message))
-                
-                # Remove from online users in Redis
-                asyncio.create_task(redis_manager.remove_online_user(room_id, username))
-            
             # Clean up
+            if room_id:
+                self._remove_from_room(client_id, room_id)
+            if room_id and username:
+                # Notify others via Redis and drop the presence entry
+                self._publish_leave(room_id, username)
             if client_id in self.user_rooms:
                 del self.user_rooms[client_id]
             if client_id in self.usernames:
                 del self.usernames[client_id]
-            if client_id in self.active_connections:
-                del self.active_connections[client_id]
+            self.authenticated_users.pop(client_id, None)
+            self.rate_limiters.pop(client_id, None)
+            del self.active_connections[client_id]
+            workers.report_connections(len(self.active_connections))
+            writer = self.writers.pop(client_id, None)
+            if writer:
+                writer.stop()
             
-            logger.info(f"Client {client_id} disconnected")
+            log_event(logger, "ws.disconnect", f"Client {client_id} disconnected")
     
     async def handle_join_room(self, client_id: str, data: dict):
         room_id = data.get("roomId", "general")
-        username = data.get("username", f"User_{client_id}")
+        if not await room_registry.exists(room_id):
+            await self._send_error(client_id, f"Room '{room_id}' does not exist")
+            return
+        # A verified token's username always wins over the one in the payload
+        username = self.authenticated_users.get(client_id) or data.get("username", f"User_{client_id}")
+        timer = metrics.PhaseTimer(metrics.JOIN_PHASE_SECONDS)
         
         # Get or create user in MongoDB
-        user_id = await mongodb_manager.get_or_create_user(username)
+        with timer.phase("mongo"):
+            user_id = await mongodb_manager.get_or_create_user(username)
         
-        # Store user info
+        # Store user info and move the client to its new room in the index
+        previous_room = self.user_rooms.get(client_id)
+        previous_username = self.usernames.get(client_id)
+        if previous_room and previous_room != room_id:
+            self._remove_from_room(client_id, previous_room)
+            if previous_username:
+                self._publish_leave(previous_room, previous_username)
         self.user_rooms[client_id] = room_id
+        self._add_to_room(client_id, room_id)
+        if data.get("coalesce") and client_id in self.writers:
+            # The client understands array frames, so busy rooms may batch its messages
+            self.writers[client_id].enable_coalescing()
         self.usernames[client_id] = username
         
-        # Update online users in Redis
-        await redis_manager.add_online_user(room_id, username)
-        
-        # Get recent messages from Redis cache first
-        recent_messages = await redis_manager.get_recent_messages(room_id)
+        with timer.phase("redis"):
+            await redis_manager.subscribe_room(room_id)
+            
+            # Update online users in Redis
+            await redis_manager.add_online_user(room_id, username)
+            
+            # A client reconnecting in streams mode only needs what it missed
+            gap = None
+            last_stream_id = data.get("lastStreamId")
+            if redis_manager.streams and last_stream_id:
+                gap = await redis_manager.get_stream_gap(room_id, str(last_stream_id))
+                metrics.STREAM_RESUMES.labels(result="reset" if gap is None else "gap").inc()
+            
+            # Get recent messages from Redis cache first, already encoded and oldest first
+            recent_payloads = gap if gap is not None else await redis_manager.get_recent_payloads(room_id)
         
-        # If Redis cache is empty, fallback to MongoDB
-        if not recent_messages:
-            recent_messages = await mongodb_manager.get_recent_messages(room_id, 50)
+        # If Redis doesn't have the room's history yet, fall back to MongoDB
+        if recent_payloads is None:
+            with timer.phase("mongo"):
+                recent_messages = await mongodb_manager.get_recent_messages(room_id, RECENT_MESSAGES_LIMIT)
             # Cache the messages in Redis for future requests
-            for message in recent_messages:
-                await redis_manager.cache_recent_message(room_id, message)
+            with timer.phase("redis"):
+                await redis_manager.backfill_recent_messages(room_id, recent_messages)
+            recent_payloads = [encode_message(message) for message in recent_messages]
         
-        # Send welcome and recent messages
+        # Send welcome and recent messages; a resumed client only gets the gap
         if client_id in self.active_connections:
-            welcome_message = {
+            if gap is not None:
+                payloads = gap
+            else:
+                welcome_message = {
+                    "id": str(uuid.uuid4()),
+                    "username": "System",
+                    "content": f"Welcome to room '{room_id}'",
+                    "timestamp": int(datetime.now().timestamp() * 1000),
+                    "room_id": room_id
+                }
+                payloads = [encode_message(welcome_message), *recent_payloads]
+            
+            with timer.phase("send"):
+                if data.get("historySnapshot"):
+                    # Upgraded clients get the welcome and backlog in a single frame
+                    self.send_to(client_id, build_history_snapshot(room_id, payloads, resumed=gap is not None))
+                else:
+                    for payload in payloads:
+                        self.send_to(client_id, payload)
+        
+        # A client moved here by another pod's drain was never announced as gone
+        # (see _publish_leave), so it isn't announced again either
+        if data.get("afterDrain"):
+            timer.observe()
+            log_event(logger, "chat.join", f"User {username} rejoined room {room_id}", room_id=room_id)
+            return
+        
+        with timer.phase("redis"):
+            # Notify others via Redis; only the delta, clients ask for a snapshot when needed
+            join_message = {
                 "id": str(uuid.uuid4()),
                 "username": "System",
-                "content": f"Welcome to room '{room_id}'",
+                "content": f"{username} joined the chat",
                 "timestamp": int(datetime.now().timestamp() * 1000),
-                "room_id": room_id
+                "room_id": room_id,
+                "joined": username
             }
-            await self.active_connections[client_id].send_json(welcome_message)
-            
-            # Send recent messages
-            for message in recent_messages:
-                await self.active_connections[client_id].send_json(message)
-        
-        # Get online users from Redis
-        online_users = await redis_manager.get_online_users(room_id)
-        
-        # Notify others via Redis
-        join_message = {
-            "id": str(uuid.uuid4()),
-            "username": "System",
-            "content": f"{username} joined the chat",
-            "timestamp": int(datetime.now().timestamp() * 1000),
-            "room_id": room_id,
-            "online_users": list(online_users)
-        }
-        await redis_manager.publish_message(room_id, join_message)
+            await redis_manager.publish_message(room_id, join_message)
         
-        logger.info(f"User {username} joined room {room_id}")
+        timer.observe()
+        log_event(logger, "chat.join", f"User {username} joined room {room_id}", room_id=room_id)
     
     async def handle_send_message(self, client_id: str, data: dict):
         room_id = self.user_rooms.get(client_id)
@@ -186,8 +419,7 @@ class ConnectionManager:
                 "content": "Please join a room first",
                 "timestamp": int(datetime.now().timestamp() * 1000)
             }
-            if client_id in self.active_connections:
-                await self.active_connections[client_id].send_json(error_message)
+            self.send_to(client_id, encode_message(error_message))
             return
         
         message_data = {
@@ -198,31 +430,123 @@ class ConnectionManager:
             "room_id": room_id
         }
         
-        # Cache in Redis first
-        await redis_manager.cache_recent_message(room_id, message_data)
+        # Encode once; the same payload is cached, published and fanned out
+        payload = encode_message(message_data)
         
-        # Publish to Redis pub/sub for real-time delivery
-        await redis_manager.publish_message(room_id, message_data)
+        # Cluster-wide per-user/per-room limit, checked in the same round trip
+        # that caches and publishes the message
+        if rate_limit.USER_ROOM_RATE > 0:
+            allowed = await redis_manager.rate_limited_publish(
+                room_id, payload, username, rate_limit.USER_ROOM_RATE, rate_limit.USER_ROOM_BURST
+            )
+            if not allowed:
+                metrics.RATE_LIMITED.labels(scope="cluster").inc()
+                self.send_to(client_id, RATE_LIMITED_FRAMES["cluster"])
+                return
+        else:
+            # Cache in Redis and publish for real-time delivery in one round trip
+            await redis_manager.cache_and_publish(room_id, payload, username=username)
         
-        # Store in MongoDB asynchronously
-        asyncio.create_task(mongodb_manager.save_message(message_data))
+        # Store in MongoDB through the batched write-behind queue
+        mongodb_manager.enqueue_message(message_data)
         
-        logger.info(f"Message in {room_id}: {username}: {message_data['content']}")
+        log_event(logger, "chat.message", f"Message in {room_id} from {username}",
+                  room_id=room_id, size=len(payload))
     
-    async def _broadcast_to_room(self, room_id: str, message: dict, exclude_client: str = None):
-        disconnected_clients = []
+    async def handle_history_request(self, client_id: str, data: dict):
+        """Send one page of older history for the client's current room"""
+        room_id = data.get("roomId") or self.user_rooms.get(client_id)
+        if not room_id:
+            await self._send_error(client_id, "Please join a room first")
+            return
+        if not isinstance(room_id, str) or not await room_registry.exists(room_id):
+            await self._send_error(client_id, "Room not found")
+            return
         
-        for client_id, websocket in self.active_connections.items():
-            if (self.user_rooms.get(client_id) == room_id and 
-                client_id != exclude_client):
-                try:
-                    await websocket.send_json(message)
-                except Exception as e:
-                    logger.error(f"Error sending to client {client_id}: {e}")
-                    disconnected_clients.append(client_id)
+        # Client input: reject bad cursors with an error frame rather than
+        # letting a conversion error drop the connection
+        before = data.get("before")
+        before_id = data.get("beforeId")
+        limit = data.get("limit", RECENT_MESSAGES_LIMIT)
+        if (before is not None and (not isinstance(before, int) or isinstance(before, bool))) \
+                or (before_id is not None and not ObjectId.is_valid(before_id)):
+            await self._send_error(client_id, "Invalid history cursor")
+            return
+        if not isinstance(limit, int) or isinstance(limit, bool):
+            await self._send_error(client_id, "Invalid history limit")
+            return
+        limit = max(1, min(limit, HISTORY_PAGE_MAX))
         
-        for client_id in disconnected_clients:
-            self.disconnect(client_id)
+        page = await mongodb_manager.get_messages_before(room_id, before, before_id, limit)
+        self.send_to(client_id, encode_message({
+            "type": "history_page",
+            "room_id": room_id,
+            **page
+        }))
+    
+    async def handle_presence_request(self, client_id: str, data: dict):
+        """Send the full online list for the client's current room"""
+        room_id = data.get("roomId") or self.user_rooms.get(client_id)
+        if not room_id:
+            await self._send_error(client_id, "Please join a room first")
+            return
+        online_users = await redis_manager.get_online_users(room_id)
+        self.send_to(client_id, encode_message({
+            "type": "presence",
+            "room_id": room_id,
+            "online_users": online_users
+        }))
+    
+    def admit(self, client_id: str) -> bool:
+        """Charge the connection's local bucket for one inbound frame"""
+        bucket = self.rate_limiters.get(client_id)
+        if bucket is None or bucket.allow():
+            return True
+        metrics.RATE_LIMITED.labels(scope="client").inc()
+        self.send_to(client_id, RATE_LIMITED_FRAMES["client"])
+        return False
+    
+    async def drain(self):
+        """Close every connection in paced batches so clients don't reconnect in one spike"""
+        client_ids = list(self.writers)
+        for start in range(0, len(client_ids), DRAIN_BATCH_SIZE):
+            batch = client_ids[start:start + DRAIN_BATCH_SIZE]
+            await asyncio.gather(*(self._close_for_drain(client_id) for client_id in batch))
+            await asyncio.sleep(DRAIN_BATCH_INTERVAL)
+    
+    async def _close_for_drain(self, client_id: str):
+        writer = self.writers.get(client_id)
+        if writer is None:
+            return
+        await writer.close_gracefully(DRAIN_CLOSE_CODE, drain_close_reason())
+    
+    def send_to(self, client_id: str, payload: str):
+        """Queue an encoded frame for one client; never waits on the socket"""
+        writer = self.writers.get(client_id)
+        if writer:
+            writer.send(payload)
+    
+    async def _broadcast_to_room(self, room_id: str, payload: str, exclude_client: str = None):
+        members = self.room_members.get(room_id)
+        if not members:
+            return
+        
+        # Snapshot the members: a writer evicted mid-loop removes itself from the room
+        recipients = [
+            self.writers[client_id]
+            for client_id in list(members)
+            if client_id != exclude_client and client_id in self.writers
+        ]
+        metrics.FANOUT_RECIPIENTS.observe(len(recipients))
+        
+        # Encode the MessagePack form once, and only if a binary client is listening
+        packed = None
+        if any(writer.binary for writer in recipients):
+            packed = wire.json_to_msgpack(payload)
+        
+        # Only enqueues; each client's writer task does the actual send
+        for writer in recipients:
+            writer.send(payload, packed)
     
     async def _send_error(self, client_id: str, message: str):
         error_msg = {
@@ -231,32 +555,67 @@ class ConnectionManager:
             "content": message,
             "timestamp": int(datetime.now().timestamp() * 1000)
         }
-        if client_id in self.active_connections:
-            await self.active_connections[client_id].send_json(error_msg)
+        self.send_to(client_id, encode_message(error_msg))
 
 # Global connection manager
 manager = ConnectionManager()
 
 @app.websocket("/ws/{client_id}")
 async def websocket_endpoint(websocket: WebSocket, client_id: str):
-    await manager.connect(websocket, client_id)
+    if manager.draining:
+        # Accept first: a refused handshake reaches the browser as a bare 1006,
+        # without the code or the reconnect hint
+        await websocket.accept(subprotocol=wire.negotiate_subprotocol(websocket))
+        await websocket.close(code=DRAIN_CLOSE_CODE, reason=drain_close_reason())
+        return
+    
+    # Browsers offer the token as a bearer.<token> subprotocol, other clients
+    # may use a Bearer header
+    token = wire.offered_token(websocket)
+    authorization = websocket.headers.get("authorization", "")
+    if not token and authorization.lower().startswith("bearer "):
+        token = authorization[len("bearer "):]
+    
+    if token and not auth.JWT_SECRET:
+        # Without a secret no token can be checked; rejecting them would log
+        # every user out, so they connect as guests instead
+        token = None
+    
+    username = None
+    claims = auth.verify_token(token) if token else None
+    if claims is not None:
+        username = claims["username"]
+    elif token or auth.REQUIRE_AUTH:
+        # Accept, then close, so the client sees a close code it can act on
+        await websocket.accept(subprotocol=wire.negotiate_subprotocol(websocket))
+        await websocket.close(code=auth.UNAUTHORIZED_CLOSE_CODE if token else auth.AUTH_REQUIRED_CLOSE_CODE)
+        return
+    
+    await manager.connect(websocket, client_id, username)
     
     try:
         while True:
-            data = await websocket.receive_json()
+            data = await wire.receive_data(websocket)
+            
+            if not manager.admit(client_id):
+                continue
             
             if "roomId" in data and "username" in data:
                 await manager.handle_join_room(client_id, data)
+            elif data.get("type") == "presence_request":
+                await manager.handle_presence_request(client_id, data)
+            elif data.get("type") == "history_request":
+                await manager.handle_history_request(client_id, data)
             elif "content" in data:
                 await manager.handle_send_message(client_id, data)
             else:
                 await manager._send_error(client_id, "Unknown message format")
                 
     except WebSocketDisconnect:
-        manager.disconnect(client_id)
+        manager.disconnect(client_id, websocket)
     except Exception as e:
         logger.error(f"WebSocket error for client {client_id}: {e}")
-        manager.disconnect(client_id)
+        manager.disconnect(client_id, websocket)
 
 # HTTP Routes
 @app.get("/")
@@ -265,20 +624,26 @@ async def root():
 
 @app.get("/health")
 async def health_check():
-    return {
-        "status": "healthy",
+    health = {
+        "status": "draining" if manager.draining else "healthy",
         "active_connections": len(manager.active_connections),
         "database": "MongoDB"
     }
+    counts = workers.all_connection_counts()
+    if counts is not None:
+        # Running under serve.py: this worker's index and every worker's connections
+        health["worker"] = workers.worker_index
+        health["worker_connections"] = counts
+        health["pod_connections"] = sum(counts)
+    if manager.draining:
+        # 503 takes the pod out of the ingress's rotation while it drains
+        return JSONResponse(status_code=503, content=health)
+    return health
 
 @app.get("/metrics")
 async def get_metrics():
-    rooms = ["general", "python", "devops", "random"]
-    room_metrics = {}
-    
-    for room in rooms:
-        stats = await mongodb_manager.get_room_stats(room)
-        room_metrics[room] = stats
+    # Counters are maintained on the write path, so a scrape is one Redis round trip
+    room_metrics = await redis_manager.get_room_stats(room_registry.ids())
     
     return {
         "server_id": os.getenv("HOSTNAME", "backend-1"),
@@ -287,14 +652,75 @@ async def get_metrics():
         "timestamp": int(datetime.now().timestamp() * 1000)
     }
 
+@app.get("/metrics/prometheus")
+async def prometheus_metrics():
+    """Hot-path histograms and gauges in Prometheus text format"""
+    return Response(content=metrics.exposition(), media_type=CONTENT_TYPE_LATEST)
+
+@app.get("/rooms/{room_id}/online")
+async def get_online_users(room_id: str):
+    if not await room_registry.exists(room_id):
+        raise HTTPException(status_code=404, detail="Room not found")
+    return {
+        "room_id": room_id,
+        "online_users": await redis_manager.get_online_users(room_id)
+    }
+
+@app.post("/metrics/reconcile")
+async def reconcile_metrics(x_admin_token: Optional[str] = Header(None)):
+    """Rebuild every room's counters from MongoDB (scans every room; operators only)"""
+    if not auth.ADMIN_TOKEN:
+        raise HTTPException(status_code=404, detail="Not found")
+    if not auth.is_admin(x_admin_token):
+        raise HTTPException(status_code=403, detail="Admin token required")
+    reconciled = await reconcile_room_stats(room_registry.ids(), force=True)
+    return {"reconciled_rooms": reconciled}
+
 @app.get("/rooms")
 async def list_rooms():
-    rooms = await mongodb_manager.get_all_rooms()
+    # Served from the in-process registry; MongoDB is only read when rooms change
     return {
-        "rooms": rooms,
+        "rooms": room_registry.all(),
         "database": "MongoDB"
     }
 
+class RoomCreate(BaseModel):
+    id: str = Field(pattern=r"^[a-z0-9][a-z0-9_-]{0,31}$")
+    name: str = Field(min_length=1, max_length=64)
+    description: str = Field(default="", max_length=256)
+
+@app.post("/rooms", status_code=status.HTTP_201_CREATED)
+async def create_room(body: RoomCreate, authorization: Optional[str] = Header(None)):
+    """Create a room at runtime; every pod picks it up through the registry"""
+    # Always authenticated, whatever REQUIRE_AUTH says: rooms outlive the request
+    token = authorization[len("bearer "):] if authorization and authorization.lower().startswith("bearer ") else None
+    if not token or auth.verify_token(token) is None:
+        raise HTTPException(status_code=401, detail="Authentication required")
+    if room_registry.is_full():
+        raise HTTPException(status_code=409, detail="Room limit reached")
+    room = {"_id": body.id, "name": body.name, "description": body.description}
+    try:
+        return await room_registry.create(room)
+    except DuplicateKeyError:
+        raise HTTPException(status_code=409, detail="Room already exists")
+
+@app.get("/rooms/{room_id}/messages")
+async def get_room_history(room_id: str, before: Optional[int] = None,
+                           before_id: Optional[str] = None, limit: int = RECENT_MESSAGES_LIMIT):
+    """Page backwards through a room's history; pass next_cursor back as before/before_id"""
+    if not await room_registry.exists(room_id):
+        raise HTTPException(status_code=404, detail="Room not found")
+    if before_id is not None and not ObjectId.is_valid(before_id):
+        raise HTTPException(status_code=400, detail="Invalid before_id cursor")
+    limit = max(1, min(limit, HISTORY_PAGE_MAX))
+    page = await mongodb_manager.get_messages_before(room_id, before, before_id, limit)
+    return {
+        "room_id": room_id,
+        **page
+    }
+
 if __name__ == "__main__":
-    import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000, log_level="info")
\ No newline at end of file
+    # Same entry point as the container (serve.py), so WEB_CONCURRENCY and the
+    # uvicorn settings behave identically however the backend is started
+    import serve
+    serve.main()
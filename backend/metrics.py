@@ -0,0 +1,154 @@
+import asyncio
+import os
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional, Tuple, Union
+
+from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram, generate_latest, multiprocess
+
+# Set by serve.py when running several workers; each worker writes its samples
+# to files in this directory and a scrape of any worker merges them all
+MULTIPROCESS = "PROMETHEUS_MULTIPROC_DIR" in os.environ
+
+# Latency buckets tuned for an in-cluster chat hot path (sub-millisecond to seconds)
+LATENCY_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0
+)
+
+DELIVERY_LATENCY = Histogram(
+    "chat_delivery_latency_seconds",
+    # Measured when the message has been queued for every local recipient; the
+    # writes themselves happen later in each ClientWriter (see chat_ws_send_seconds)
+    "Time from a message being stamped by the sender's pod to being queued for every local recipient",
+    buckets=LATENCY_BUCKETS
+)
+WS_SEND_SECONDS = Histogram(
+    "chat_ws_send_seconds",
+    "Time spent writing one frame to one WebSocket",
+    buckets=LATENCY_BUCKETS
+)
+FANOUT_RECIPIENTS = Histogram(
+    "chat_fanout_recipients",
+    "Number of local recipients per broadcast message",
+    buckets=(0, 1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+)
+JOIN_PHASE_SECONDS = Histogram(
+    "chat_join_phase_seconds",
+    "Time spent in each phase of a room join",
+    ["phase"],
+    buckets=LATENCY_BUCKETS
+)
+WRITE_QUEUE_DEPTH = Gauge(
+    "chat_mongo_write_queue_depth",
+    "Messages waiting in the MongoDB write-behind queue",
+    multiprocess_mode="liveall"
+)
+ACTIVE_CONNECTIONS = Gauge(
+    "chat_active_connections",
+    "WebSocket connections open on this process",
+    multiprocess_mode="liveall"
+)
+RATE_LIMITED = Counter(
+    "chat_rate_limited_total",
+    "Inbound frames rejected by admission control",
+    ["scope"]
+)
+STREAM_RESUMES = Counter(
+    "chat_stream_resumes_total",
+    "Reconnects that asked to resume from a stream id, by outcome",
+    ["result"]
+)
+EVENT_LOOP_LAG = Histogram(
+    "chat_event_loop_lag_seconds",
+    "How late the event loop runs a timer scheduled on a fixed interval",
+    buckets=LATENCY_BUCKETS
+)
+
+
+def extract_timestamp(payload: str) -> Optional[int]:
+    """Read the millisecond "timestamp" field of an encoded message without parsing it"""
+    start = payload.find('"timestamp":')
+    if start == -1:
+        return None
+    start += len('"timestamp":')
+    end = start
+    while end < len(payload) and payload[end].isdigit():
+        end += 1
+    return int(payload[start:end]) if end > start else None
+
+
+def observe_delivery(payload: str):
+    sent_at = extract_timestamp(payload)
+    if sent_at is not None:
+        # Wall-clock stamps from other pods; negative skew is clamped to zero
+        DELIVERY_LATENCY.observe(max(time.time() - sent_at / 1000, 0.0))
+
+
+class PhaseTimer:
+    """Accumulates time per phase so a phase entered several times is observed once"""
+    
+    def __init__(self, histogram: Histogram):
+        self.histogram = histogram
+        self.totals: Dict[str, float] = {}
+    
+    @contextmanager
+    def phase(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.totals[name] = self.totals.get(name, 0.0) + time.perf_counter() - start
+    
+    def observe(self):
+        for name, total in self.totals.items():
+            self.histogram.labels(phase=name).observe(total)
+
+
+async def timed_send(websocket, payload: Union[str, bytes]):
+    start = time.perf_counter()
+    try:
+        if isinstance(payload, bytes):
+            await websocket.send_bytes(payload)
+        else:
+            await websocket.send_text(payload)
+    finally:
+        WS_SEND_SECONDS.observe(time.perf_counter() - start)
+
+
+async def monitor_event_loop_lag(interval: float = 0.5):
+    loop = asyncio.get_running_loop()
+    while True:
+        expected = loop.time() + interval
+        await asyncio.sleep(interval)
+        EVENT_LOOP_LAG.observe(max(loop.time() - expected, 0.0))
+
+
+_sampled_gauges: List[Tuple[Gauge, Callable[[], float]]] = []
+
+
+def gauge_function(gauge: Gauge, f: Callable[[], float]):
+    """Gauge.set_function that also works in multiprocess mode.
+    
+    Multiprocess scrapes only read the values workers have written out, so
+    there the function is sampled by sample_gauges instead.
+    """
+    if MULTIPROCESS:
+        _sampled_gauges.append((gauge, f))
+    else:
+        gauge.set_function(f)
+
+
+async def sample_gauges(interval: float = 1.0):
+    while True:
+        for gauge, f in _sampled_gauges:
+            gauge.set(f())
+        await asyncio.sleep(interval)
+
+
+def exposition() -> bytes:
+    """Current metrics in the Prometheus text format, merged across workers if there are several"""
+    if not MULTIPROCESS:
+        return generate_latest()
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return generate_latest(registry)
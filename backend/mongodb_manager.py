@@ -1,28 +1,168 @@
+import asyncio
+import logging
 import motor.motor_asyncio
+from bson import ObjectId
+from pymongo import ASCENDING, DESCENDING, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError, PyMongoError
+from cache import TTLCache
+from logging_setup import log_event
 from datetime import datetime
 import os
 from typing import Optional, List
 
+logger = logging.getLogger(__name__)
+
+DUPLICATE_KEY_ERROR = 11000
+
 class MongoDBManager:
     def __init__(self):
         self.mongo_url = os.getenv("MONGO_URL", "mongodb://mongodb:27017/chatroom")
         self.client: Optional[motor.motor_asyncio.AsyncIOMotorClient] = None
         self.db = None
+        
+        # username -> user_id, so rejoins during reconnect storms skip MongoDB
+        self.user_cache = TTLCache(
+            maxsize=int(os.getenv("USER_CACHE_SIZE", "10000")),
+            ttl=float(os.getenv("USER_CACHE_TTL", "600"))
+        )
+        
+        # Write-behind buffer for chat messages
+        self.write_batch_size = int(os.getenv("MONGO_WRITE_BATCH_SIZE", "200"))
+        self.write_flush_interval = int(os.getenv("MONGO_WRITE_FLUSH_MS", "50")) / 1000
+        self.write_max_retries = int(os.getenv("MONGO_WRITE_MAX_RETRIES", "3"))
+        self._write_queue: asyncio.Queue = asyncio.Queue(
+            maxsize=int(os.getenv("MONGO_WRITE_QUEUE_SIZE", "10000"))
+        )
+        self._writer_task: Optional[asyncio.Task] = None
+        self.messages_written = 0
+        self.messages_dropped = 0
+        self.messages_failed = 0
     
     async def connect(self):
         try:
             self.client = motor.motor_asyncio.AsyncIOMotorClient(self.mongo_url)
             self.db = self.client.get_database()
             await self.db.command("ping")
-            print("✅ Connected to MongoDB successfully!")
+            logger.info("✅ Connected to MongoDB successfully!")
         except Exception as e:
-            print(f"❌ MongoDB connection failed: {e}")
+            logger.error(f"❌ MongoDB connection failed: {e}")
             raise
     
     async def disconnect(self):
         if self.client:
             self.client.close()
     
+    async def ensure_indexes(self):
+        """Create the indexes the history and user lookups rely on"""
+        # (room_id, timestamp) serves the recent/paged history range reads;
+        # _id breaks ties between messages sharing a millisecond
+        await self.db.messages.create_index(
+            [("room_id", ASCENDING), ("timestamp", ASCENDING), ("_id", ASCENDING)],
+            name="room_id_timestamp"
+        )
+        try:
+            await self.db.users.create_index("username", unique=True, name="username_unique")
+        except PyMongoError as e:
+            # Existing duplicate users must be cleaned up before the index can build
+            logger.warning(f"⚠️  Could not create unique index on users.username: {e}")
+        logger.info("✅ MongoDB indexes ensured")
+    
+    # Write-behind buffer
+    def start_writer(self):
+        if self._writer_task is None:
+            self._writer_task = asyncio.create_task(self._write_loop())
+    
+    async def stop_writer(self, timeout: float = 10.0):
+        """Flush buffered messages and stop the writer task"""
+        if self._writer_task is None:
+            return
+        try:
+            await asyncio.wait_for(self._write_queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"⚠️  MongoDB flush timed out with {self._write_queue.qsize()} message(s) pending")
+        self._writer_task.cancel()
+        try:
+            await self._writer_task
+        except asyncio.CancelledError:
+            pass
+        self._writer_task = None
+        logger.info(f"✅ MongoDB writer stopped ({self.messages_written} written, "
+              f"{self.messages_dropped} dropped, {self.messages_failed} failed)")
+    
+    def enqueue_message(self, message_data: dict) -> bool:
+        """Queue a message for batched persistence.
+        
+        Never blocks the caller: when the queue is full the message is dropped
+        (it is still delivered live and cached in Redis) and False is returned.
+        """
+        message_to_store = message_data.copy()
+        if 'timestamp' not in message_to_store:
+            message_to_store['timestamp'] = int(datetime.now().timestamp() * 1000)
+        try:
+            self._write_queue.put_nowait(message_to_store)
+            return True
+        except asyncio.QueueFull:
+            self.messages_dropped += 1
+            if self.messages_dropped % 1000 == 1:
+                logger.warning(f"⚠️  MongoDB write queue full - {self.messages_dropped} message(s) dropped so far")
+            return False
+    
+    def write_queue_depth(self) -> int:
+        return self._write_queue.qsize()
+    
+    async def _write_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._write_queue.get()]
+            deadline = loop.time() + self.write_flush_interval
+            # Collect until the batch is full or the flush interval expires
+            while len(batch) < self.write_batch_size:
+                try:
+                    batch.append(self._write_queue.get_nowait())
+                    continue
+                except asyncio.QueueEmpty:
+                    pass
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._write_queue.get(), remaining))
+                except asyncio.TimeoutError:
+                    break
+            try:
+                await self._flush_batch(batch)
+            finally:
+                for _ in batch:
+                    self._write_queue.task_done()
+    
+    async def _flush_batch(self, batch: List[dict]):
+        pending = batch
+        for attempt in range(self.write_max_retries + 1):
+            try:
+                # insert_many sets _id on each document, so a retry of the same
+                # documents can't create duplicates - they fail with 11000 instead
+                await self.db.messages.insert_many(pending, ordered=False)
+                self.messages_written += len(pending)
+                log_event(logger, "mongo.insert", f"✅ MongoDB stored {len(pending)} message(s)", batch_size=len(pending))
+                return
+            except BulkWriteError as e:
+                write_errors = e.details.get("writeErrors", [])
+                retry_indexes = {
+                    err["index"] for err in write_errors
+                    if err.get("code") != DUPLICATE_KEY_ERROR
+                }
+                self.messages_written += len(pending) - len(retry_indexes)
+                pending = [doc for i, doc in enumerate(pending) if i in retry_indexes]
+                if not pending:
+                    return
+                error = e
+            except Exception as e:
+                error = e
+            if attempt < self.write_max_retries:
+                await asyncio.sleep(0.1 * (2 ** attempt))
+        self.messages_failed += len(pending)
+        logger.error(f"❌ MongoDB batch insert failed, dropping {len(pending)} message(s): {error}")
+    
     # User operations
     async def create_user(self, username: str) -> str:
         user_data = {
@@ -33,12 +173,30 @@ class MongoDBManager:
         return str(result.inserted_id)
     
     async def get_or_create_user(self, username: str) -> str:
-        """Get existing user or create new one"""
-        user = await self.db.users.find_one({"username": username})
-        if user:
-            return str(user["_id"])
-        else:
-            return await self.create_user(username)
+        """Get existing user or create new one in a single atomic upsert"""
+        user_id = self.user_cache.get(username)
+        if user_id is not None:
+            return user_id
+        
+        try:
+            user = await self._upsert_user(username)
+        except DuplicateKeyError:
+            # Another pod inserted the same username between our match and insert;
+            # the retry matches its document instead
+            user = await self._upsert_user(username)
+        
+        user_id = str(user["_id"])
+        self.user_cache.set(username, user_id)
+        return user_id
+    
+    async def _upsert_user(self, username: str) -> dict:
+        return await self.db.users.find_one_and_update(
+            {"username": username},
+            {"$setOnInsert": {"username": username, "created_at": datetime.now()}},
+            projection={"_id": 1},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
     
     async def get_user(self, username: str) -> Optional[dict]:
         user = await self.db.users.find_one({"username": username})
@@ -46,22 +204,11 @@ class MongoDBManager:
             user["_id"] = str(user["_id"])
         return user
     
-    # Message operations - stores timestamp as number (milliseconds)
-    async def save_message(self, message_data: dict) -> str:
-        message_to_store = message_data.copy()
-        # Ensure timestamp is stored as a number for consistency
-        if 'timestamp' not in message_to_store:
-            message_to_store['timestamp'] = int(datetime.now().timestamp() * 1000)
-        
-        result = await self.db.messages.insert_one(message_to_store)
-        message_id = str(result.inserted_id)
-        print(f"✅ MongoDB stored message with ID: {message_id}")
-        return message_id
-    
+    # Message operations - timestamps are stored as numbers (milliseconds)
     async def get_recent_messages(self, room_id: str, limit: int = 50) -> List[dict]:
         cursor = self.db.messages.find(
             {"room_id": room_id}
-        ).sort("timestamp", -1).limit(limit)
+        ).sort([("timestamp", DESCENDING), ("_id", DESCENDING)]).limit(limit)
         
         messages = []
         async for message in cursor:
@@ -70,6 +217,45 @@ class MongoDBManager:
         
         return list(reversed(messages))  # Return in chronological order
     
+    async def get_messages_before(self, room_id: str, before: Optional[int] = None,
+                                  before_id: Optional[str] = None, limit: int = 50) -> dict:
+        """Page backwards through a room's history from a (timestamp, _id) cursor.
+        
+        Returns the page in chronological order plus the cursor for the next
+        (older) page, or None when the start of the history has been reached.
+        """
+        query = {"room_id": room_id}
+        if before is not None:
+            if before_id is not None:
+                query["$or"] = [
+                    {"timestamp": {"$lt": before}},
+                    {"timestamp": before, "_id": {"$lt": ObjectId(before_id)}}
+                ]
+            else:
+                query["timestamp"] = {"$lt": before}
+        
+        # Fetch one extra document to learn whether an older page exists
+        cursor = self.db.messages.find(query).sort(
+            [("timestamp", DESCENDING), ("_id", DESCENDING)]
+        ).limit(limit + 1)
+        
+        messages = []
+        async for message in cursor:
+            message["_id"] = str(message["_id"])
+            messages.append(message)
+        
+        has_more = len(messages) > limit
+        messages = messages[:limit]
+        next_cursor = None
+        if has_more:
+            oldest = messages[-1]
+            next_cursor = {"before": oldest["timestamp"], "before_id": oldest["_id"]}
+        
+        return {
+            "messages": list(reversed(messages)),
+            "next_cursor": next_cursor
+        }
+    
     async def get_room_messages_count(self, room_id: str) -> int:
         return await self.db.messages.count_documents({"room_id": room_id})
     
@@ -80,6 +266,25 @@ class MongoDBManager:
             room["_id"] = str(room["_id"])
         return room
     
+    async def seed_rooms(self, rooms: List[dict]) -> int:
+        """Insert any missing rooms in one bulk round trip; existing rooms are left untouched"""
+        result = await self.db.rooms.bulk_write(
+            [
+                UpdateOne(
+                    {"_id": room["_id"]},
+                    {"$setOnInsert": {key: value for key, value in room.items() if key != "_id"}},
+                    upsert=True
+                )
+                for room in rooms
+            ],
+            ordered=False
+        )
+        return result.upserted_count
+    
+    async def create_room(self, room: dict):
+        """Insert a new room; raises DuplicateKeyError if the id is taken"""
+        await self.db.rooms.insert_one(dict(room))
+    
     async def get_all_rooms(self) -> List[dict]:
         cursor = self.db.rooms.find()
         rooms = []
@@ -89,24 +294,13 @@ class MongoDBManager:
         return rooms
     
     # Statistics
-    async def get_room_stats(self, room_id: str) -> dict:
-        message_count = await self.get_room_messages_count(room_id)
-        
-        # Get unique users in this room (last 24 hours)
-        one_day_ago = int((datetime.now().timestamp() - 86400) * 1000)
+    async def get_room_posters_since(self, room_id: str, since: int) -> List[str]:
+        """Distinct usernames that posted in a room since a millisecond timestamp"""
         pipeline = [
-            {"$match": {"room_id": room_id, "timestamp": {"$gte": one_day_ago}}},
-            {"$group": {"_id": "$username"}},
-            {"$count": "unique_users"}
+            {"$match": {"room_id": room_id, "timestamp": {"$gte": since}}},
+            {"$group": {"_id": "$username"}}
         ]
-        
-        unique_users_result = await self.db.messages.aggregate(pipeline).to_list(length=1)
-        unique_users = unique_users_result[0]["unique_users"] if unique_users_result else 0
-        
-        return {
-            "message_count": message_count,
-            "active_users_today": unique_users
-        }
+        return [doc["_id"] async for doc in self.db.messages.aggregate(pipeline) if doc["_id"]]
 
 # Global MongoDB manager instance
 mongodb_manager = MongoDBManager()
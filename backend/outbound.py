@@ -0,0 +1,186 @@
+import asyncio
+import logging
+import os
+from collections import deque
+from typing import Callable, Deque, Optional, Union
+
+from fastapi import WebSocket
+from prometheus_client import Counter, Gauge, Histogram
+
+import metrics
+from wire import batch_frames, json_to_msgpack
+
+logger = logging.getLogger(__name__)
+
+# What to do when a client's outbound queue is full:
+#   drop_oldest - discard the oldest queued frame to make room
+#   coalesce    - replace the whole backlog with one resync notice; the client
+#                 pages the most recent history back in with a history_request
+#   disconnect  - close the socket with SLOW_CONSUMER_CLOSE_CODE
+OVERFLOW_POLICIES = ("drop_oldest", "coalesce", "disconnect")
+OUTBOUND_QUEUE_SIZE = int(os.getenv("OUTBOUND_QUEUE_SIZE", "256"))
+OVERFLOW_POLICY = os.getenv("OUTBOUND_OVERFLOW_POLICY", "drop_oldest")
+# 1013 "Try Again Later": the client may reconnect once its network recovers
+SLOW_CONSUMER_CLOSE_CODE = int(os.getenv("SLOW_CONSUMER_CLOSE_CODE", "1013"))
+
+# Opt-in batching: a client that asks for it gets frames queued within this
+# window after its previous send packed into one array frame (0 disables)
+COALESCE_WINDOW_MS = float(os.getenv("OUTBOUND_COALESCE_MS", "5"))
+COALESCE_MAX_FRAMES = int(os.getenv("OUTBOUND_COALESCE_MAX_FRAMES", "64"))
+
+if OVERFLOW_POLICY not in OVERFLOW_POLICIES:
+    raise ValueError(f"OUTBOUND_OVERFLOW_POLICY must be one of {OVERFLOW_POLICIES}")
+
+QUEUE_DEPTH = Histogram(
+    "chat_outbound_queue_depth",
+    "Frames already queued for a client when a new frame is enqueued",
+    buckets=(0, 1, 2, 5, 10, 25, 50, 100, 250, 500, 1000)
+)
+QUEUED_FRAMES = Gauge(
+    "chat_outbound_queued_frames",
+    "Frames waiting in all outbound queues on this process",
+    multiprocess_mode="liveall"
+)
+OVERFLOWS = Counter(
+    "chat_outbound_overflows_total",
+    "Outbound queue overflows by the policy applied",
+    ["policy"]
+)
+FRAMES_SAVED = Counter(
+    "chat_outbound_frames_saved_total",
+    "Frames avoided by packing several messages into one array frame"
+)
+EVICTIONS = Counter(
+    "chat_outbound_evictions_total",
+    "Clients disconnected by their outbound writer",
+    ["reason"]
+)
+
+
+class ClientWriter:
+    """Owns all writes to one WebSocket through a bounded queue and its own task.
+    
+    Broadcasters only enqueue, so a slow or dead client can never hold up the
+    Redis subscriber or the rest of its room.
+    """
+    
+    def __init__(self, client_id: str, websocket: WebSocket,
+                 on_evict: Callable[[str, WebSocket], None], binary: bool = False,
+                 maxsize: int = OUTBOUND_QUEUE_SIZE, policy: str = OVERFLOW_POLICY):
+        self.client_id = client_id
+        self.websocket = websocket
+        # Binary clients negotiated MessagePack; everyone else gets JSON text frames
+        self.binary = binary
+        self.maxsize = maxsize
+        self.policy = policy
+        self._on_evict = on_evict
+        self._queue: Deque[Union[str, bytes]] = deque()
+        self._ready = asyncio.Event()
+        self._dropped = 0
+        self._closed = False
+        # Seconds; set by the manager when the client opts in to array frames
+        self.coalesce_window = 0.0
+        self._task = asyncio.create_task(self._run())
+    
+    def depth(self) -> int:
+        return len(self._queue)
+    
+    def send(self, payload: str, packed: Optional[bytes] = None):
+        """Queue a JSON frame without waiting; applies the overflow policy when full.
+        
+        Broadcasters pass the MessagePack form as packed so it is encoded once
+        per message rather than once per binary recipient.
+        """
+        if self._closed:
+            return
+        if self.binary:
+            payload = packed if packed is not None else json_to_msgpack(payload)
+        QUEUE_DEPTH.observe(len(self._queue))
+        if len(self._queue) >= self.maxsize:
+            OVERFLOWS.labels(policy=self.policy).inc()
+            if self.policy == "disconnect":
+                self.evict("slow_consumer", SLOW_CONSUMER_CLOSE_CODE)
+                return
+            if self.policy == "coalesce":
+                self._dropped += len(self._queue)
+                self._queue.clear()
+            else:
+                self._queue.popleft()
+        self._queue.append(payload)
+        self._ready.set()
+    
+    def enable_coalescing(self):
+        self.coalesce_window = COALESCE_WINDOW_MS / 1000
+    
+    def _next_frame(self) -> Union[str, bytes]:
+        if not self.coalesce_window or len(self._queue) == 1:
+            return self._queue.popleft()
+        frames = [self._queue.popleft() for _ in range(min(len(self._queue), COALESCE_MAX_FRAMES))]
+        FRAMES_SAVED.inc(len(frames) - 1)
+        return batch_frames(frames, self.binary)
+    
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        last_send = float("-inf")
+        while True:
+            if not self._queue and not self._dropped:
+                self._ready.clear()
+                await self._ready.wait()
+                continue
+            if self._dropped:
+                # Tell the client how many frames it missed; it answers with a history_request
+                dropped, self._dropped = self._dropped, 0
+                payload = '{"type":"resync","dropped":' + str(dropped) + '}'
+                if self.binary:
+                    payload = json_to_msgpack(payload)
+            else:
+                if self.coalesce_window:
+                    # A quiet client sends at once; a busy one waits out the window
+                    # after its last send so whatever arrives meanwhile shares a frame
+                    remaining = last_send + self.coalesce_window - loop.time()
+                    if remaining > 0:
+                        await asyncio.sleep(remaining)
+                        if not self._queue:
+                            continue
+                payload = self._next_frame()
+            try:
+                await metrics.timed_send(self.websocket, payload)
+            except Exception as e:
+                logger.error(f"Error sending to client {self.client_id}: {e}")
+                self.evict("send_failed")
+                return
+            last_send = loop.time()
+    
+    async def close_gracefully(self, code: int, reason: str = "", timeout: float = 1.0):
+        """Send what is already queued (for up to timeout seconds), then close the socket"""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while (self._queue or self._dropped) and not self._closed and loop.time() < deadline:
+            await asyncio.sleep(0.01)
+        self.stop()
+        try:
+            await self.websocket.close(code=code, reason=reason)
+        except Exception:
+            pass
+    
+    def evict(self, reason: str, close_code: Optional[int] = None):
+        """Stop writing and hand the client back to the manager for cleanup"""
+        if self._closed:
+            return
+        EVICTIONS.labels(reason=reason).inc()
+        self.stop()
+        if close_code is not None:
+            asyncio.create_task(self._close(close_code))
+        self._on_evict(self.client_id, self.websocket)
+    
+    async def _close(self, code: int):
+        try:
+            await self.websocket.close(code=code)
+        except Exception:
+            pass
+    
+    def stop(self):
+        self._closed = True
+        self._queue.clear()
+        if self._task is not asyncio.current_task():
+            self._task.cancel()
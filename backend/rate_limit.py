@@ -0,0 +1,72 @@
+import os
+import time
+
+# Per-connection limit on inbound frames, enforced locally with no I/O
+CLIENT_RATE = float(os.getenv("CLIENT_RATE_LIMIT", "10"))
+CLIENT_BURST = float(os.getenv("CLIENT_RATE_BURST", "20"))
+
+# Cluster-wide limit on chat messages per user per room, enforced in Redis
+USER_ROOM_RATE = float(os.getenv("USER_ROOM_RATE_LIMIT", "5"))
+USER_ROOM_BURST = float(os.getenv("USER_ROOM_RATE_BURST", "10"))
+
+
+class TokenBucket:
+    """Classic token bucket: refills at rate tokens/s up to burst"""
+    
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+    
+    def allow(self) -> bool:
+        if self.rate <= 0:
+            return True
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+# Token bucket check and the whole send path in one atomic round trip:
+# a rejected message is never cached, counted or published.
+# KEYS: bucket, recent list (or room stream), message count, today's posters
+# ARGV: rate, burst, payload, channel, recent limit, username, posters ttl,
+#       stream maxlen (0 for pub/sub delivery)
+SEND_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local time = redis.call('TIME')
+local now = tonumber(time[1]) * 1000 + math.floor(tonumber(time[2]) / 1000)
+
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(bucket[1]) or burst
+local ts = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + (now - ts) / 1000 * rate)
+
+local allowed = 0
+if tokens >= 1 then
+  tokens = tokens - 1
+  allowed = 1
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', now)
+redis.call('PEXPIRE', KEYS[1], math.ceil(burst / rate * 1000) + 1000)
+if allowed == 0 then
+  return 0
+end
+
+redis.call('INCR', KEYS[3])
+redis.call('PFADD', KEYS[4], ARGV[6])
+redis.call('EXPIRE', KEYS[4], tonumber(ARGV[7]))
+if tonumber(ARGV[8]) > 0 then
+  redis.call('XADD', KEYS[2], 'MAXLEN', '~', ARGV[8], '*', 'p', ARGV[3])
+else
+  redis.call('LPUSH', KEYS[2], ARGV[3])
+  redis.call('LTRIM', KEYS[2], 0, tonumber(ARGV[5]) - 1)
+  redis.call('PUBLISH', ARGV[4], ARGV[3])
+end
+return 1
+"""
@@ -1,86 +1,523 @@
+import asyncio
+import logging
+from datetime import datetime, timezone
 import redis.asyncio as redis
-import json
-from typing import Optional
+import orjson
+from typing import Awaitable, Callable, Dict, Optional, Set, Union
 import os
+import socket
+import time
+import uuid
+from logging_setup import log_event
+from rate_limit import SEND_SCRIPT
+
+logger = logging.getLogger(__name__)
+
+RECENT_MESSAGES_LIMIT = 50
+POSTERS_KEY_TTL = 2 * 86400
+# Presence entries not refreshed by a heartbeat within this many seconds are offline
+PRESENCE_TTL = int(os.getenv("PRESENCE_TTL", "30"))
+
+
+# "pubsub" delivers live messages over pub/sub and keeps history in a capped list;
+# "streams" uses one capped stream per room for both, so clients can resume
+DELIVERY_MODE = os.getenv("REDIS_DELIVERY_MODE", "pubsub")
+STREAM_MAXLEN = int(os.getenv("STREAM_MAXLEN", "1000"))
+STREAM_READ_BLOCK_MS = int(os.getenv("STREAM_READ_BLOCK_MS", "500"))
+# Longer gaps are answered with the regular backlog instead
+STREAM_RESUME_MAX = int(os.getenv("STREAM_RESUME_MAX", "500"))
+# A stream shorter than the backlog is topped up with older MongoDB history,
+# cached once per room for this long
+STREAM_SEED_TTL = 86400
+# Every worker of every pod reconciles at startup; the lock lets one of them
+# rebuild a room while the rest skip it. Expires in case the holder dies.
+STATS_REBUILD_LOCK_TTL = 120
+
+# Applies a rebuilt count as a delta and marks the room reconciled, but only
+# while the caller still holds the rebuild lock
+RESET_STATS_SCRIPT = """
+if redis.call('GET', KEYS[1]) ~= ARGV[1] then
+    return 0
+end
+redis.call('INCRBY', KEYS[2], ARGV[2])
+redis.call('SET', KEYS[3], '1')
+for i = 4, #ARGV, 500 do
+    redis.call('PFADD', KEYS[4], unpack(ARGV, i, math.min(i + 499, #ARGV)))
+end
+if #ARGV >= 4 then
+    redis.call('EXPIRE', KEYS[4], ARGV[3])
+end
+return 1
+"""
+
+UNLOCK_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+def stream_id_key(stream_id: str) -> tuple:
+    """Stream ids ("<ms>-<seq>") as a tuple that orders like Redis does"""
+    ms, _, seq = stream_id.partition("-")
+    return (int(ms), int(seq or 0))
+
+
+def with_stream_id(payload: str, stream_id: str) -> str:
+    """Tag an encoded message object with its stream entry id without re-encoding it"""
+    return payload[:-1] + ',"stream_id":"' + stream_id + '"}'
+
+
+def stats_day(timestamp: Optional[float] = None) -> str:
+    """UTC day bucket used for the per-day distinct poster counters"""
+    moment = datetime.fromtimestamp(timestamp, timezone.utc) if timestamp else datetime.now(timezone.utc)
+    return moment.strftime("%Y%m%d")
+
+
+def encode_message(message: Union[dict, str]) -> str:
+    """Serialize a message once; already-encoded payloads pass through unchanged"""
+    if isinstance(message, str):
+        return message
+    return orjson.dumps(message).decode("utf-8")
+
+
+def decode_message(payload: Union[str, bytes]) -> dict:
+    return orjson.loads(payload)
 
 class RedisManager:
     def __init__(self):
         self.redis_url = os.getenv("REDIS_URL", "redis://localhost:6379")
         self.redis: Optional[redis.Redis] = None
         self.is_connected = False
+        # Presence entries are tagged with the process that owns the connection,
+        # so one pod leaving or dying never affects another pod's users
+        self.instance_id = f"{os.getenv('POD_NAME') or socket.gethostname()}:{os.getpid()}"
+        # Single pub/sub connection shared by every room this pod has members in
+        self.pubsub = None
+        self.subscribed_rooms: Set[str] = set()
+        self._active_channels: Set[str] = set()
+        self._subscription_lock = asyncio.Lock()
+        self._subscriptions_changed = asyncio.Event()
+        self._needs_resubscribe = False
+        # Non-room channels (e.g. cache invalidation) and their handlers
+        self.control_channels: Dict[str, Callable[[str], Awaitable[None]]] = {}
+        # Streams delivery: the last entry id fanned out per subscribed room
+        self.streams = DELIVERY_MODE == "streams"
+        self._stream_cursors: Dict[str, str] = {}
+        self._streams_changed = asyncio.Event()
 
     async def connect(self):
         self.redis = redis.from_url(self.redis_url, decode_responses=True)
         await self.redis.ping()
+        # EVALSHA with automatic script loading on first use
+        self._send_script = self.redis.register_script(SEND_SCRIPT)
+        self._reset_stats_script = self.redis.register_script(RESET_STATS_SCRIPT)
+        self._unlock_script = self.redis.register_script(UNLOCK_SCRIPT)
         self.is_connected = True
-        print("✅ Connected to Redis")
+        logger.info("✅ Connected to Redis")
     
     async def disconnect(self):
         if self.redis:
             await self.redis.close()
             self.is_connected = False
-            print("🔌 Disconnected from Redis")
+            logger.info("🔌 Disconnected from Redis")
 
-    async def publish_message(self, room_id: str, message: dict):
+    async def publish_message(self, room_id: str, message: Union[dict, str]):
         if self.redis and self.is_connected:
-            await self.redis.publish(f"room:{room_id}", json.dumps(message))
-            print(f"📤 Published message to room:{room_id}")
+            await self.redis.publish(f"room:{room_id}", encode_message(message))
+            log_event(logger, "redis.publish", f"📤 Published message to room:{room_id}", room_id=room_id)
         else:
-            print(f"⚠️  Redis not connected - message not published to {room_id}")
+            logger.warning(f"⚠️  Redis not connected - message not published to {room_id}")
 
-    async def subscribe_to_room(self, room_id: str, callback):
+    async def publish_control(self, channel: str, data: str):
         if self.redis and self.is_connected:
+            await self.redis.publish(channel, data)
+
+    # Pub/sub - one multiplexed subscriber per pod
+    def add_control_channel(self, channel: str, handler: Callable[[str], Awaitable[None]]):
+        """Listen on a non-room channel for as long as the subscriber runs.
+        
+        Register before run_subscriber starts; the channel is subscribed on every (re)connect.
+        """
+        self.control_channels[channel] = handler
+    async def subscribe_room(self, room_id: str):
+        self.subscribed_rooms.add(room_id)
+        if self.streams and room_id not in self._stream_cursors:
+            # Fan out everything after the current tail; joiners read the backlog themselves
+            tail = await self._stream_tail(room_id)
+            # Another first join may have set (and the reader advanced) the cursor meanwhile,
+            # or the room may have been left; only a still-wanted, unset cursor takes the tail
+            if room_id in self.subscribed_rooms and room_id not in self._stream_cursors:
+                self._stream_cursors[room_id] = tail
+                self._streams_changed.set()
+        await self._sync_room_subscription(room_id)
+
+    def unsubscribe_room(self, room_id: str):
+        # Interest is dropped synchronously so a re-join racing this call wins;
+        # the UNSUBSCRIBE itself is sent in the background
+        self.subscribed_rooms.discard(room_id)
+        self._stream_cursors.pop(room_id, None)
+        asyncio.create_task(self._sync_room_subscription(room_id))
+
+    async def _sync_room_subscription(self, room_id: str):
+        """Bring the pub/sub connection in line with subscribed_rooms for one room"""
+        async with self._subscription_lock:
+            if self.pubsub is None:
+                # The subscriber subscribes to every wanted room when it (re)connects
+                return
+            channel = f"room:{room_id}"
+            wanted = room_id in self.subscribed_rooms
             try:
-                pubsub = self.redis.pubsub()
-                await pubsub.subscribe(f"room:{room_id}")
-                print(f"✅ Subscribed to Redis channel: room:{room_id}")
-                
-                async for message in pubsub.listen():
-                    if message['type'] == 'message':
-                        print(f"🔍 Redis received message on {room_id}: {message['data']}")
-                        try:
-                            data = json.loads(message['data'])
-                            await callback(data)
-                        except json.JSONDecodeError as e:
-                            print(f"❌ Error parsing Redis message: {e}")
+                if wanted and channel not in self._active_channels:
+                    await self.pubsub.subscribe(channel)
+                    self._active_channels.add(channel)
+                    logger.info(f"✅ Subscribed to Redis channel: {channel}")
+                elif not wanted and channel in self._active_channels:
+                    await self.pubsub.unsubscribe(channel)
+                    self._active_channels.discard(channel)
+                    logger.info(f"🔕 Unsubscribed from Redis channel: {channel}")
             except Exception as e:
-                print(f"❌ Redis subscription error for {room_id}: {e}")
-        else:
-            print(f"❌ Cannot subscribe to {room_id} - Redis not connected")
+                logger.error(f"❌ Redis subscription change failed for {channel}: {e}")
+                self._needs_resubscribe = True
+            self._subscriptions_changed.set()
+
+    async def _open_pubsub(self):
+        async with self._subscription_lock:
+            if self.pubsub is not None:
+                try:
+                    await self.pubsub.reset()
+                except Exception:
+                    pass
+            self._active_channels.clear()
+            self._needs_resubscribe = False
+            self.pubsub = self.redis.pubsub()
+            channels = [f"room:{room_id}" for room_id in self.subscribed_rooms] + list(self.control_channels)
+            if channels:
+                await self.pubsub.subscribe(*channels)
+                self._active_channels.update(channels)
+            logger.info(f"✅ Redis subscriber listening on {len(channels)} channel(s)")
+
+    async def run_subscriber(self, callback):
+        """Listen on the shared pub/sub connection, reconnecting and resubscribing on failure"""
+        backoff = 1
+        while True:
+            try:
+                await self._open_pubsub()
+                backoff = 1
+                while True:
+                    if self._needs_resubscribe:
+                        raise ConnectionError("a subscription change was lost")
+                    if not self._active_channels:
+                        # Nothing to listen to until a local client joins a room
+                        self._subscriptions_changed.clear()
+                        await self._subscriptions_changed.wait()
+                        continue
+                    message = await self.pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+                    if message and message['type'] == 'message' and message['channel'] in self.control_channels:
+                        await self.control_channels[message['channel']](message['data'])
+                    elif message and message['type'] == 'message':
+                        room_id = message['channel'].split(":", 1)[1]
+                        log_event(logger, "redis.receive", f"🔍 Redis received message on {room_id}",
+                                  room_id=room_id, size=len(message['data']))
+                        # The payload is already encoded JSON; hand it on untouched
+                        await callback(room_id, message['data'])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"❌ Redis subscriber error: {e} - reconnecting in {backoff}s")
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, 30)
+
+    # Streams delivery - one capped stream per room, read by every pod with members in it
+    async def _stream_tail(self, room_id: str) -> str:
+        entries = await self.redis.xrevrange(f"room:{room_id}:stream", count=1)
+        return entries[0][0] if entries else "0-0"
+
+    async def run_stream_reader(self, callback):
+        """Fan out new entries of every subscribed room's stream.
+        
+        Cursors survive Redis errors, so after a reconnect the reader picks up
+        exactly where it stopped instead of losing what was published meanwhile.
+        """
+        backoff = 1
+        while True:
+            try:
+                if not self._stream_cursors:
+                    # Nothing to read until a local client joins a room
+                    self._streams_changed.clear()
+                    await self._streams_changed.wait()
+                    continue
+                streams = {f"room:{room_id}:stream": cursor for room_id, cursor in self._stream_cursors.items()}
+                # Rooms subscribed while blocked are picked up on the next read
+                response = await self.redis.xread(streams, block=STREAM_READ_BLOCK_MS)
+                backoff = 1
+                for key, entries in response or []:
+                    room_id = key[len("room:"):-len(":stream")]
+                    for entry_id, fields in entries:
+                        cursor = self._stream_cursors.get(room_id)
+                        # Skip rooms left meanwhile and entries a re-subscribe already passed
+                        if cursor is None or stream_id_key(entry_id) <= stream_id_key(cursor):
+                            continue
+                        self._stream_cursors[room_id] = entry_id
+                        log_event(logger, "redis.receive", f"🔍 Redis stream entry on {room_id}",
+                                  room_id=room_id, size=len(fields["p"]))
+                        await callback(room_id, with_stream_id(fields["p"], entry_id))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"❌ Redis stream reader error: {e} - retrying in {backoff}s")
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, 30)
+
+    async def get_stream_gap(self, room_id: str, last_id: str) -> Optional[list]:
+        """Encoded messages published after last_id, oldest first.
+        
+        Returns None when the gap can't be served from the stream - the id is
+        malformed, the stream was trimmed past it or the gap is too long - and
+        the caller should send the regular backlog instead.
+        """
+        if not (self.redis and self.is_connected):
+            return None
+        try:
+            last_key = stream_id_key(last_id)
+        except ValueError:
+            return None
+        key = f"room:{room_id}:stream"
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.xrange(key, count=1)
+            pipe.xrange(key, min=f"({last_id}", count=STREAM_RESUME_MAX + 1)
+            oldest, gap = await pipe.execute()
+        # An empty or missing stream (never posted to, or Redis was flushed) can't
+        # vouch for the gap; the full backlog includes the welcome message
+        if not oldest or stream_id_key(oldest[0][0]) > last_key:
+            return None
+        if len(gap) > STREAM_RESUME_MAX:
+            return None
+        return [with_stream_id(fields["p"], entry_id) for entry_id, fields in gap]
 
     # Session storage
     async def store_user_session(self, user_id: str, session_data: dict):
         if self.redis and self.is_connected:
-            await self.redis.setex(f"user_session:{user_id}", 3600, json.dumps(session_data))
+            await self.redis.setex(f"user_session:{user_id}", 3600, encode_message(session_data))
 
     async def get_user_session(self, user_id: str) -> Optional[dict]:
         if self.redis and self.is_connected:
             data = await self.redis.get(f"user_session:{user_id}")
-            return json.loads(data) if data else None
+            return decode_message(data) if data else None
         return None
         
-    # Online user tracking
-    async def add_online_user(self, room_id: str, user_id: str):
+    # Online user tracking - one sorted set per room, scored by last heartbeat (ms)
+    def _presence_member(self, username: str) -> str:
+        return f"{self.instance_id}|{username}"
+
+    async def add_online_user(self, room_id: str, username: str):
         if self.redis and self.is_connected:
-            await self.redis.sadd(f"room:{room_id}:online_users", user_id)
+            key = f"room:{room_id}:presence"
+            async with self.redis.pipeline(transaction=False) as pipe:
+                pipe.zadd(key, {self._presence_member(username): int(time.time() * 1000)})
+                pipe.expire(key, PRESENCE_TTL * 2)
+                await pipe.execute()
 
-    async def remove_online_user(self, room_id: str, user_id: str):
+    async def remove_online_user(self, room_id: str, username: str):
         if self.redis and self.is_connected:
-            await self.redis.srem(f"room:{room_id}:online_users", user_id)
+            await self.redis.zrem(f"room:{room_id}:presence", self._presence_member(username))
+
+    async def heartbeat_presence(self, room_users: dict):
+        """Refresh this process's presence entries for {room_id: usernames} in one round trip"""
+        if self.redis and self.is_connected and room_users:
+            now = int(time.time() * 1000)
+            cutoff = now - PRESENCE_TTL * 1000
+            async with self.redis.pipeline(transaction=False) as pipe:
+                for room_id, usernames in room_users.items():
+                    key = f"room:{room_id}:presence"
+                    pipe.zadd(key, {self._presence_member(username): now for username in usernames})
+                    # Drop entries left behind by processes that stopped heartbeating
+                    pipe.zremrangebyscore(key, "-inf", cutoff)
+                    pipe.expire(key, PRESENCE_TTL * 2)
+                await pipe.execute()
 
     async def get_online_users(self, room_id: str) -> list:
         if self.redis and self.is_connected:
-            return await self.redis.smembers(f"room:{room_id}:online_users")
+            cutoff = int(time.time() * 1000) - PRESENCE_TTL * 1000
+            members = await self.redis.zrangebyscore(f"room:{room_id}:presence", cutoff, "+inf")
+            return sorted({member.split("|", 1)[1] for member in members})
         return []
     
     # Message caching - recent messages
-    async def cache_recent_message(self, room_id: str, message: dict):
+    async def cache_and_publish(self, room_id: str, message: Union[dict, str], username: Optional[str] = None):
+        """Cache, trim and publish a message in a single round trip.
+        
+        When username is given the message also counts towards the room's
+        statistics (message count and today's distinct posters).
+        """
         if self.redis and self.is_connected:
-            await self.redis.lpush(f"room:{room_id}:recent_messages", json.dumps(message))
-            await self.redis.ltrim(f"room:{room_id}:recent_messages", 0, 49)
+            payload = encode_message(message)
+            async with self.redis.pipeline(transaction=True) as pipe:
+                if username is not None:
+                    posters_key = f"room:{room_id}:posters:{stats_day()}"
+                    pipe.incr(f"room:{room_id}:message_count")
+                    pipe.pfadd(posters_key, username)
+                    pipe.expire(posters_key, POSTERS_KEY_TTL)
+                if self.streams:
+                    # The stream is both the history and the live feed
+                    pipe.xadd(f"room:{room_id}:stream", {"p": payload}, maxlen=STREAM_MAXLEN, approximate=True)
+                else:
+                    key = f"room:{room_id}:recent_messages"
+                    pipe.lpush(key, payload)
+                    pipe.ltrim(key, 0, RECENT_MESSAGES_LIMIT - 1)
+                    pipe.publish(f"room:{room_id}", payload)
+                await pipe.execute()
+        else:
+            logger.warning(f"⚠️  Redis not connected - message not published to {room_id}")
+
+    async def rate_limited_publish(self, room_id: str, message: Union[dict, str], username: str,
+                                   rate: float, burst: float) -> bool:
+        """Charge the user's per-room token bucket and, if allowed, cache, count and
+        publish the message - all atomically in one round trip. Returns False when
+        the bucket is empty and nothing was written.
+        """
+        if not (self.redis and self.is_connected):
+            logger.warning(f"⚠️  Redis not connected - message not published to {room_id}")
+            return True
+        payload = encode_message(message)
+        allowed = await self._send_script(
+            keys=[
+                f"ratelimit:{room_id}:{username}",
+                f"room:{room_id}:stream" if self.streams else f"room:{room_id}:recent_messages",
+                f"room:{room_id}:message_count",
+                f"room:{room_id}:posters:{stats_day()}"
+            ],
+            args=[rate, burst, payload, f"room:{room_id}", RECENT_MESSAGES_LIMIT, username, POSTERS_KEY_TTL,
+                  STREAM_MAXLEN if self.streams else 0]
+        )
+        return bool(allowed)
+
+    async def backfill_recent_messages(self, room_id: str, messages: list):
+        """Cache a chronological history loaded from MongoDB in one round trip"""
+        if not (self.redis and self.is_connected):
+            return
+        if self.streams:
+            # Anything added to a stream is fanned out as new, so older history is
+            # kept beside it. Only what predates the stream's first entry is kept;
+            # later messages are in the stream already. Stored even when empty, so
+            # a quiet room is looked up in MongoDB once, not on every join.
+            oldest = await self.redis.xrange(f"room:{room_id}:stream", count=1)
+            if oldest:
+                first_ms = stream_id_key(oldest[0][0])[0]
+                messages = [message for message in messages if message.get("timestamp", 0) < first_ms]
+            seed = "\n".join(encode_message(message) for message in messages)
+            await self.redis.set(f"room:{room_id}:history_seed", seed, ex=STREAM_SEED_TTL)
+            return
+        if messages:
+            key = f"room:{room_id}:recent_messages"
+            async with self.redis.pipeline(transaction=True) as pipe:
+                # DEL keeps concurrent cold-cache joins from stacking duplicate copies
+                pipe.delete(key)
+                # LPUSH of the chronological list leaves the newest message at the head
+                pipe.lpush(key, *[encode_message(message) for message in messages])
+                pipe.ltrim(key, 0, RECENT_MESSAGES_LIMIT - 1)
+                await pipe.execute()
+
+    async def get_recent_payloads(self, room_id: str) -> Optional[list]:
+        """Encoded recent messages, oldest first.
+        
+        Returns None when Redis doesn't hold the room's history yet; the caller
+        loads it from MongoDB and hands it to backfill_recent_messages.
+        """
+        if not (self.redis and self.is_connected):
+            return None
+        if self.streams:
+            async with self.redis.pipeline(transaction=False) as pipe:
+                pipe.xrevrange(f"room:{room_id}:stream", count=RECENT_MESSAGES_LIMIT)
+                pipe.get(f"room:{room_id}:history_seed")
+                entries, seed = await pipe.execute()
+            entries.reverse()
+            payloads = [with_stream_id(fields["p"], entry_id) for entry_id, fields in entries]
+            if len(payloads) >= RECENT_MESSAGES_LIMIT:
+                return payloads
+            if seed is None:
+                return None
+            # newline never appears inside an encoded message
+            older = seed.split("\n") if seed else []
+            return (older + payloads)[-RECENT_MESSAGES_LIMIT:]
+        payloads = await self.redis.lrange(f"room:{room_id}:recent_messages", 0, -1)
+        if not payloads:
+            return None
+        # LPUSH stores newest-first; normalize to chronological order here, once
+        payloads.reverse()
+        return payloads
 
     async def get_recent_messages(self, room_id: str) -> list:
+        """Recent messages, oldest first"""
+        return [decode_message(payload) for payload in await self.get_recent_payloads(room_id) or []]
+
+    # Room statistics - maintained on the write path, read in O(1)
+    async def get_room_stats(self, room_ids: list) -> dict:
+        if not (self.redis and self.is_connected):
+            return {}
+        day = stats_day()
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for room_id in room_ids:
+                pipe.get(f"room:{room_id}:message_count")
+                pipe.pfcount(f"room:{room_id}:posters:{day}")
+            results = await pipe.execute()
+        return {
+            room_id: {
+                "message_count": int(results[2 * i] or 0),
+                "active_users_today": results[2 * i + 1]
+            }
+            for i, room_id in enumerate(room_ids)
+        }
+
+    async def has_room_stats(self, room_id: str) -> bool:
+        """Whether the room's counters were rebuilt since Redis last lost them.
+        
+        Checks a marker rather than message_count itself, since the first live
+        INCR after a flush recreates the counter without the older messages.
+        """
         if self.redis and self.is_connected:
-            messages = await self.redis.lrange(f"room:{room_id}:recent_messages", 0, -1)
-            return [json.loads(msg) for msg in messages]
-        return []
+            return bool(await self.redis.exists(f"room:{room_id}:stats_reconciled"))
+        return False
+
+    async def lock_room_stats(self, room_id: str) -> Optional[str]:
+        """Take the room's rebuild lock; returns the token to pass on, or None if it is held"""
+        if not (self.redis and self.is_connected):
+            return None
+        token = uuid.uuid4().hex
+        acquired = await self.redis.set(f"room:{room_id}:stats_rebuild", token, nx=True, ex=STATS_REBUILD_LOCK_TTL)
+        return token if acquired else None
+
+    async def unlock_room_stats(self, room_id: str, token: str):
+        if self.redis and self.is_connected:
+            await self._unlock_script(keys=[f"room:{room_id}:stats_rebuild"], args=[token])
+
+    async def get_room_message_count(self, room_id: str) -> int:
+        if self.redis and self.is_connected:
+            return int(await self.redis.get(f"room:{room_id}:message_count") or 0)
+        return 0
+
+    async def reset_room_stats(self, room_id: str, message_count: int, posters_today: list,
+                               baseline: int, lock_token: str) -> bool:
+        """Bring a room's counters in line with values rebuilt from MongoDB.
+        
+        baseline is the Redis count read before MongoDB was counted. The
+        difference is applied with INCRBY rather than a SET, so messages counted
+        while the rebuild ran are kept. Posters are merged into today's
+        HyperLogLog rather than replacing it, for the same reason; a rebuild can
+        therefore add missing posters but never remove any. Nothing is applied
+        unless lock_token still holds the room's rebuild lock, so concurrent
+        rebuilds can never add the same delta twice. Returns whether it applied.
+        """
+        if not (self.redis and self.is_connected):
+            return False
+        applied = await self._reset_stats_script(
+            keys=[
+                f"room:{room_id}:stats_rebuild",
+                f"room:{room_id}:message_count",
+                f"room:{room_id}:stats_reconciled",
+                f"room:{room_id}:posters:{stats_day()}"
+            ],
+            args=[lock_token, message_count - baseline, POSTERS_KEY_TTL, *posters_today]
+        )
+        return bool(applied)
@@ -0,0 +1,110 @@
+import asyncio
+import logging
+import os
+from typing import Dict, List, Optional
+
+from cache import TTLCache
+from mongodb_manager import mongodb_manager
+
+logger = logging.getLogger(__name__)
+
+# Any pod that changes the rooms collection announces it here; every pod reloads
+ROOMS_CHANNEL = "rooms:changed"
+# Safety net for announcements missed while a pod's subscriber was reconnecting
+ROOM_REGISTRY_REFRESH = int(os.getenv("ROOM_REGISTRY_REFRESH", "60"))
+# Upper bound on rooms, since any logged-in user can create one
+MAX_ROOMS = int(os.getenv("MAX_ROOMS", "100"))
+# How long an unknown room id is answered from memory before MongoDB is asked again
+ROOM_MISS_TTL = float(os.getenv("ROOM_MISS_TTL", "5"))
+
+DEFAULT_ROOMS = [
+    {"_id": "general", "name": "General Chat", "description": "Main discussion room"},
+    {"_id": "python", "name": "Python Programming", "description": "Python-related discussions"},
+    {"_id": "devops", "name": "DevOps & Cloud", "description": "Cloud infrastructure and DevOps"},
+    {"_id": "random", "name": "Random Discussions", "description": "Off-topic conversations"}
+]
+
+
+class RoomRegistry:
+    """In-process copy of the rooms collection, so joins and /rooms never query MongoDB"""
+    
+    def __init__(self, redis_manager):
+        self.redis_manager = redis_manager
+        self.rooms: Dict[str, dict] = {}
+        # Negative cache, so probing unknown ids doesn't turn into one MongoDB query each
+        self._misses = TTLCache(maxsize=10000, ttl=ROOM_MISS_TTL)
+        self._reload_task: Optional[asyncio.Task] = None
+        self._reload_pending = False
+    
+    async def seed_defaults(self):
+        created = await mongodb_manager.seed_rooms(DEFAULT_ROOMS)
+        if created:
+            logger.info(f"✅ Created {created} default room(s)")
+    
+    async def load(self):
+        rooms = await mongodb_manager.get_all_rooms()
+        # Swapped in whole so readers never see a half-built registry
+        self.rooms = {room["_id"]: room for room in rooms}
+        self._misses.clear()
+    
+    def get(self, room_id: str) -> Optional[dict]:
+        return self.rooms.get(room_id)
+    
+    def all(self) -> List[dict]:
+        return list(self.rooms.values())
+    
+    def ids(self) -> List[str]:
+        return list(self.rooms)
+    
+    def is_full(self) -> bool:
+        return len(self.rooms) >= MAX_ROOMS
+    
+    async def exists(self, room_id: str) -> bool:
+        if room_id in self.rooms:
+            return True
+        if self._misses.get(room_id):
+            return False
+        # A room created on another pod may not have been announced here yet
+        room = await mongodb_manager.get_room(room_id)
+        if room:
+            self.rooms = {**self.rooms, room_id: room}
+        else:
+            self._misses.set(room_id, True)
+        return room is not None
+    
+    async def create(self, room: dict) -> dict:
+        """Store a new room and tell every pod; raises DuplicateKeyError if the id is taken"""
+        await mongodb_manager.create_room(room)
+        self.rooms = {**self.rooms, room["_id"]: room}
+        self._misses.pop(room["_id"])
+        await self.redis_manager.publish_control(ROOMS_CHANNEL, room["_id"])
+        logger.info(f"✅ Created room: {room['name']}")
+        return room
+    
+    async def handle_change(self, data: str):
+        # Reloaded off the shared subscriber loop; changes arriving mid-reload
+        # fold into one more reload instead of stacking up
+        if self._reload_task and not self._reload_task.done():
+            self._reload_pending = True
+            return
+        self._reload_task = asyncio.create_task(self._reload(data))
+    
+    async def _reload(self, data: str):
+        while True:
+            self._reload_pending = False
+            try:
+                await self.load()
+            except Exception as e:
+                # The periodic refresh catches up
+                logger.error(f"Room registry reload after change to {data} failed: {e}")
+                return
+            if not self._reload_pending:
+                return
+    
+    async def refresh_periodically(self):
+        while True:
+            await asyncio.sleep(ROOM_REGISTRY_REFRESH)
+            try:
+                await self.load()
+            except Exception as e:
+                logger.error(f"Room registry refresh failed: {e}")
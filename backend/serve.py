@@ -0,0 +1,164 @@
+"""Run the chat backend as N uvicorn workers sharing one port.
+
+Each worker is a separate process with its own uvloop event loop,
+ConnectionManager, Redis subscriber and MongoDB writer. Every worker binds its
+own listening socket with SO_REUSEPORT, so the kernel spreads new connections
+across them. WEB_CONCURRENCY defaults to the cores the container may use.
+"""
+import logging
+import math
+import multiprocessing
+import os
+import shutil
+import signal
+import socket
+import sys
+import time
+
+import uvicorn
+
+from logging_setup import configure_logging
+
+HOST = os.getenv("HOST", "0.0.0.0")
+PORT = int(os.getenv("PORT", "8000"))
+# 0 = one worker per CPU of the container's quota (see available_cpus)
+WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY", "0"))
+# A worker that dies sooner than this after starting is treated as a failed
+# startup (e.g. MongoDB unreachable) and stops the pod instead of crash-looping
+WORKER_STARTUP_GRACE = 10.0
+# Shared by the workers so /metrics/prometheus reports the whole pod
+DEFAULT_MULTIPROC_DIR = "/tmp/chat-prometheus"
+
+logger = logging.getLogger("serve")
+
+
+def available_cpus() -> int:
+    """CPUs this process may actually use: the container's CPU quota if it has
+    one, else the CPUs it is allowed to run on (not the node's core count)"""
+    cpus = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else (os.cpu_count() or 1)
+    try:
+        # cgroup v2: "<quota> <period>" or "max <period>"
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            quota, period = f.read().split()
+        if quota != "max":
+            cpus = min(cpus, math.ceil(int(quota) / int(period)))
+    except (OSError, ValueError):
+        try:
+            # cgroup v1
+            with open("/sys/fs/cgroup/cpu/cpu.cfs_quota_us") as f:
+                quota = int(f.read())
+            with open("/sys/fs/cgroup/cpu/cpu.cfs_period_us") as f:
+                period = int(f.read())
+            if quota > 0:
+                cpus = min(cpus, math.ceil(quota / period))
+        except (OSError, ValueError):
+            pass
+    return max(cpus, 1)
+
+
+def uvicorn_config() -> uvicorn.Config:
+    # permessage-deflate is only used when the client offers it; set to false to save CPU
+    ws_per_message_deflate = os.getenv("UVICORN_WS_PER_MESSAGE_DEFLATE", "true").lower() == "true"
+    # log_config=None leaves uvicorn's loggers without handlers of their own, so
+    # their records propagate to the root logger's queue instead of being
+    # written to stdout synchronously on the event loop
+    return uvicorn.Config("main:app", loop="uvloop", http="httptools", log_level="info", log_config=None,
+                          ws_per_message_deflate=ws_per_message_deflate)
+
+
+def bind_socket() -> socket.socket:
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((HOST, PORT))
+    return sock
+
+
+def serve():
+    server = uvicorn.Server(uvicorn_config())
+    server.run(sockets=[bind_socket()])
+    if not server.started:
+        # Same exit code uvicorn.run uses when application startup fails
+        sys.exit(3)
+
+
+def run_worker(index: int, connection_counts):
+    import workers
+    configure_logging()
+    workers.attach(index, connection_counts)
+    serve()
+
+
+def prepare_multiproc_dir() -> str:
+    path = os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", DEFAULT_MULTIPROC_DIR)
+    # Files left by a previous run would be merged into this run's metrics
+    shutil.rmtree(path, ignore_errors=True)
+    os.makedirs(path)
+    return path
+
+
+def supervise(count: int):
+    prepare_multiproc_dir()
+    from prometheus_client import multiprocess
+    
+    # Spawned rather than forked so no worker inherits another's event loop or sockets
+    context = multiprocessing.get_context("spawn")
+    connection_counts = context.Array("i", count, lock=False)
+    processes = {}
+    started_at = {}
+    stopping = False
+    
+    def start(index: int):
+        process = context.Process(target=run_worker, args=(index, connection_counts), name=f"worker-{index}")
+        process.start()
+        processes[index] = process
+        started_at[index] = time.monotonic()
+        logger.info(f"✅ Started worker {index} (pid {process.pid})")
+    
+    def forward(sig, frame):
+        # Each worker drains its own connections on SIGTERM
+        nonlocal stopping
+        stopping = True
+        for process in processes.values():
+            if process.is_alive():
+                os.kill(process.pid, sig)
+    
+    signal.signal(signal.SIGTERM, forward)
+    signal.signal(signal.SIGINT, forward)
+    
+    for index in range(count):
+        start(index)
+    
+    exit_code = 0
+    while processes:
+        time.sleep(0.5)
+        for index, process in list(processes.items()):
+            if process.is_alive():
+                continue
+            multiprocess.mark_process_dead(process.pid)
+            connection_counts[index] = 0
+            del processes[index]
+            if stopping:
+                continue
+            if time.monotonic() - started_at[index] < WORKER_STARTUP_GRACE:
+                logger.error(f"❌ Worker {index} failed to start (exit code {process.exitcode}) - stopping")
+                exit_code = 1
+                forward(signal.SIGTERM, None)
+            else:
+                logger.error(f"❌ Worker {index} (pid {process.pid}) exited with {process.exitcode} - restarting")
+                start(index)
+    return exit_code
+
+
+def main():
+    configure_logging()
+    count = WEB_CONCURRENCY or available_cpus()
+    if count <= 1:
+        serve()
+    else:
+        logger.info(f"Starting {count} workers on {HOST}:{PORT}")
+        sys.exit(supervise(count))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+from typing import List, Optional, Union
+
+import msgpack
+import orjson
+from fastapi import WebSocket, WebSocketDisconnect
+
+# Sec-WebSocket-Protocol values a client may offer; JSON stays the default
+# when none is offered, so existing clients are unaffected
+MSGPACK_SUBPROTOCOL = "chat.msgpack.v1"
+JSON_SUBPROTOCOL = "chat.json.v1"
+SUPPORTED_SUBPROTOCOLS = (MSGPACK_SUBPROTOCOL, JSON_SUBPROTOCOL)
+# Browsers can't set an Authorization header on a WebSocket, so they offer the
+# JWT as an extra "bearer.<token>" subprotocol; it is never selected or echoed.
+# Unlike ?token=, this keeps the token out of access logs.
+TOKEN_SUBPROTOCOL_PREFIX = "bearer."
+
+
+def negotiate_subprotocol(websocket: WebSocket) -> Optional[str]:
+    """Pick the server's preferred subprotocol among those the client offered"""
+    offered = {
+        protocol.strip()
+        for protocol in websocket.headers.get("sec-websocket-protocol", "").split(",")
+        if protocol.strip()
+    }
+    for protocol in SUPPORTED_SUBPROTOCOLS:
+        if protocol in offered:
+            return protocol
+    return None
+
+
+def offered_token(websocket: WebSocket) -> Optional[str]:
+    """The JWT a client offered as a bearer.<token> subprotocol, if any"""
+    for protocol in websocket.headers.get("sec-websocket-protocol", "").split(","):
+        protocol = protocol.strip()
+        if protocol.startswith(TOKEN_SUBPROTOCOL_PREFIX):
+            return protocol[len(TOKEN_SUBPROTOCOL_PREFIX):]
+    return None
+
+
+def json_to_msgpack(payload: str) -> bytes:
+    """Re-encode an already-serialized JSON frame as MessagePack"""
+    return msgpack.packb(orjson.loads(payload))
+
+
+def batch_frames(frames: List[Union[str, bytes]], binary: bool) -> Union[str, bytes]:
+    """Join already-encoded frames into one array frame without decoding them"""
+    if binary:
+        return msgpack.Packer().pack_array_header(len(frames)) + b"".join(frames)
+    return "[" + ",".join(frames) + "]"
+
+
+async def receive_data(websocket: WebSocket) -> dict:
+    """Read one client frame: binary frames are MessagePack, text frames JSON"""
+    message = await websocket.receive()
+    if message["type"] == "websocket.disconnect":
+        raise WebSocketDisconnect(message.get("code", 1000))
+    if message.get("bytes") is not None:
+        return msgpack.unpackb(message["bytes"])
+    return orjson.loads(message["text"])
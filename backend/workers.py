@@ -0,0 +1,24 @@
+from typing import List, Optional
+
+# Filled in by serve.py inside each worker process; left unset when the app
+# runs as a single process (plain uvicorn or `python main.py`)
+worker_index: Optional[int] = None
+# Per-worker open connection counts in memory shared by every worker of the pod
+connection_counts = None
+
+
+def attach(index: int, counts):
+    global worker_index, connection_counts
+    worker_index = index
+    connection_counts = counts
+
+
+def report_connections(count: int):
+    if connection_counts is not None:
+        connection_counts[worker_index] = count
+
+
+def all_connection_counts() -> Optional[List[int]]:
+    if connection_counts is None:
+        return None
+    return list(connection_counts)
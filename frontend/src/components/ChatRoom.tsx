@@ -5,8 +5,10 @@ import MessageList from './MessageList';
 import MessageInput from './MessageInput';
 import '../styles/chatroom.css';
 
-// Available rooms
-const ROOMS = [
+const API_URL = import.meta.env.VITE_API_URL || '/api';
+
+// Shown until the backend's room list arrives (or if it can't be fetched)
+const DEFAULT_ROOMS = [
   { id: 'general', name: 'General Chat' },
   { id: 'python', name: 'Python' },
   { id: 'devops', name: 'DevOps' },
@@ -16,6 +18,7 @@ const ROOMS = [
 export default function ChatRoom({ user = 'guest' }: { user?: string }) {
   const [messages, setMessages] = useState<Message[]>([]);
   const [currentRoom, setCurrentRoom] = useState('general');
+  const [rooms, setRooms] = useState(DEFAULT_ROOMS);
   const [isGuest] = useState(user.startsWith('guest'));
   const serviceRef = useRef<ChatService | null>(null);
 
@@ -24,7 +27,14 @@ export default function ChatRoom({ user = 'guest' }: { user?: string }) {
     serviceRef.current = service;
     service.connect(user, currentRoom);
     const unsub = service.onMessage((m) => {
-      setMessages((s) => [...s, m]);
+      setMessages((s) => {
+        // History reloaded after a resync or reconnect repeats messages already shown
+        // and fills gaps behind newer ones: skip repeats, place the rest by timestamp
+        if (s.some((existing) => existing.id === m.id)) return s;
+        let at = s.length;
+        while (at > 0 && s[at - 1].timestamp > m.timestamp) at--;
+        return [...s.slice(0, at), m, ...s.slice(at)];
+      });
     });
     return () => {
       unsub();
@@ -32,6 +42,16 @@ export default function ChatRoom({ user = 'guest' }: { user?: string }) {
     };
   }, [user]); // Only depend on user, not room
 
+  // Rooms can be created at runtime, so the list comes from the backend
+  useEffect(() => {
+    fetch(`${API_URL}/rooms`)
+      .then((response) => (response.ok ? response.json() : Promise.reject(response.status)))
+      .then((data: { rooms: { _id: string; name: string }[] }) => {
+        if (data.rooms.length) setRooms(data.rooms.map((room) => ({ id: room._id, name: room.name })));
+      })
+      .catch((error) => console.error('Failed to load rooms: ', error));
+  }, []);
+
   // Function to switch rooms
   const switchRoom = (roomId: string) => {
     if (roomId === currentRoom) return; // Don't switch to same room
@@ -68,7 +88,7 @@ export default function ChatRoom({ user = 'guest' }: { user?: string }) {
           )}
         </div>
         <div className="room-buttons">
-          {ROOMS.map(room => (
+          {rooms.map(room => (
             <button
               key={room.id}
               onClick={() => switchRoom(room.id)}
@@ -1,6 +1,8 @@
-import type { Message } from '../types/message';
+import type { ControlFrame, HistoryPage, HistorySnapshot, Message, ResyncFrame } from '../types/message';
+import authService from './authService';
 
 type MessageHandler = (message: Message) => void;
+type Frame = Message | HistorySnapshot | HistoryPage | ResyncFrame | ControlFrame;
 
 export default class ChatService {
 	private ws: WebSocket | null = null;
@@ -10,6 +12,9 @@ export default class ChatService {
 	private url: string;
 	private clientId: string;
 	private currentUsername: string = '';
+	private currentRoomId: string = 'general';
+	// Last stream id seen per room, so a dropped socket resumes instead of reloading
+	private lastStreamIds: Record<string, string> = {};
 
 	constructor() {
 		this.clientId = this.generateClientId();
@@ -31,8 +36,12 @@ export default class ChatService {
 		this.createSocket(username, roomId);
 	}
 
-	private createSocket(username: string, roomId: string) {
-		this.ws = new WebSocket(this.url);
+	private createSocket(username: string, roomId: string, resume: boolean = false, afterDrain: boolean = false) {
+		this.currentRoomId = roomId;
+		// Logged-in users authenticate the socket itself; guests connect without a token.
+		// The token rides along as an extra subprotocol so it never appears in a URL.
+		const token = authService.getToken();
+		this.ws = token ? new WebSocket(this.url, ['chat.json.v1', `bearer.${token}`]) : new WebSocket(this.url);
 
 		this.ws.addEventListener('open', () => {
 			console.log('Connected to chat server: ', this.url);
@@ -41,7 +50,12 @@ export default class ChatService {
 			// Send join room message immediately after connection
 			const joinMessage = {
 				roomId: roomId,
-				username: username
+				username: username,
+				historySnapshot: true,
+				coalesce: true,
+				...(resume && this.lastStreamIds[roomId] ? { lastStreamId: this.lastStreamIds[roomId] } : {}),
+				// The draining server didn't announce us leaving, so don't announce the return
+				...(afterDrain ? { afterDrain: true } : {})
 			};
 			this.ws?.send(JSON.stringify(joinMessage));
 			console.log('Sent join message:', joinMessage);
@@ -49,19 +63,56 @@ export default class ChatService {
 
 		this.ws.addEventListener('message', (event) => {
 			try {
-				const message: Message = JSON.parse(event.data);
-				console.log('Received message:', message);
-				this.handlers.forEach((handler) => handler(message));
+				const data: Frame | Frame[] = JSON.parse(event.data);
+				// Busy rooms may batch several frames into one array frame
+				const frames = Array.isArray(data) ? data : [data];
+				// The join backlog arrives as one history frame, oldest message first
+				// Chat messages carry no type; any other typed frame is control traffic, not a chat line
+				const messages = frames.flatMap((frame): Message[] => {
+					if (!('type' in frame)) return [frame];
+					if (frame.type === 'history') return frame.messages.map((message) => ({ room_id: frame.room_id, ...message }));
+					// Pages only arrive in answer to a resync; a page for a room we've left is stale
+					if (frame.type === 'history_page') {
+						return frame.room_id === this.currentRoomId
+							? frame.messages.map((message) => ({ room_id: frame.room_id, ...message }))
+							: [];
+					}
+					if (frame.type === 'resync') this.requestMissedHistory(frame.dropped);
+					if (frame.type === 'rate_limited') console.warn('Rate limited:', frame.content);
+					return [];
+				});
+				console.log('Received messages:', messages.length);
+				// Keyed by the message's own room: frames from the previous room can still
+				// arrive after joinRoom has switched currentRoomId
+				messages.forEach((message) => {
+					if (message.stream_id) this.lastStreamIds[message.room_id ?? this.currentRoomId] = message.stream_id;
+				});
+				messages.forEach((message) => this.handlers.forEach((handler) => handler(message)));
 			} catch (error) {
 				console.error('Error parsing message: ', error);
 			}
 		});
 
-		this.ws.addEventListener('close', () => {
+		this.ws.addEventListener('close', (event) => {
 			if (!this.shouldReconnect) return;
 			console.log('Disconnected from chat server: ', this.url);
-			setTimeout(() => this.createSocket(this.currentUsername, 'general'), this.reconnectDelay);
-			this.reconnectDelay = Math.min(this.reconnectDelay * 2, 30000);
+			if (event.code === 4401 && token) {
+				// Expired or rejected token: retrying with it would fail forever, so continue as a guest
+				console.warn('Chat token rejected; reconnecting as guest');
+				authService.logout();
+				this.createSocket(this.currentUsername, this.currentRoomId, true);
+				return;
+			}
+			if (event.code === 4403) {
+				// The server only admits logged-in users; retrying without a token cannot succeed
+				console.warn('Chat requires login; not reconnecting');
+				this.shouldReconnect = false;
+				return;
+			}
+			// A draining server spreads reconnects out with a per-client hint
+			const delay = event.code === 1012 ? this.drainReconnectDelay(event.reason) : this.reconnectDelay;
+			setTimeout(() => this.createSocket(this.currentUsername, this.currentRoomId, true, event.code === 1012), delay);
+			if (event.code !== 1012) this.reconnectDelay = Math.min(this.reconnectDelay * 2, 30000);
 		});
 
 		this.ws.addEventListener('error', (error) => {
@@ -70,6 +121,22 @@ export default class ChatService {
 		});
 	}
 
+	// The server dropped frames this client was too slow to take; fetch the latest page instead
+	private requestMissedHistory(dropped: number) {
+		console.warn('Missed messages, reloading recent history:', dropped);
+		this.ws?.send(JSON.stringify({ type: 'history_request', roomId: this.currentRoomId, limit: dropped }));
+	}
+
+	private drainReconnectDelay(reason: string): number {
+		try {
+			const hint = JSON.parse(reason).reconnect_after_ms;
+			if (typeof hint === 'number') return hint;
+		} catch {
+			// No usable hint; fall back to the normal backoff
+		}
+		return this.reconnectDelay;
+	}
+
 	sendMessage(content: string) {
 		if (this.ws && this.ws.readyState === WebSocket.OPEN) {
 			const chatMessage = {
@@ -85,9 +152,12 @@ export default class ChatService {
 	joinRoom(roomId: string, username: string) {
 		this.currentUsername = username;
 		if (this.ws && this.ws.readyState === WebSocket.OPEN) {
+			this.currentRoomId = roomId;
 			const joinMessage = {
 				roomId: roomId,
-				username: username
+				username: username,
+				historySnapshot: true,
+				coalesce: true
 			};
 			this.ws.send(JSON.stringify(joinMessage));
 			console.log('Sent room join:', joinMessage);
@@ -3,4 +3,34 @@ export type Message = {
 	username: string;
 	content: string;
 	timestamp: number;
-};
\ No newline at end of file
+	room_id?: string;
+	// Set in streams delivery mode; sent back on reconnect to resume from here
+	stream_id?: string;
+};
+
+export type HistorySnapshot = {
+	type: 'history';
+	room_id: string;
+	// True when the frame only holds what was missed since the last stream id
+	resumed?: boolean;
+	messages: Message[];
+};
+
+// A page of older history, sent in answer to a history_request
+export type HistoryPage = {
+	type: 'history_page';
+	room_id: string;
+	messages: Message[];
+};
+
+// The server dropped this many queued frames because the client read too slowly
+export type ResyncFrame = {
+	type: 'resync';
+	dropped: number;
+};
+
+// Non-chat frames the server sends alongside messages; never rendered as chat lines
+export type ControlFrame = {
+	type: 'rate_limited' | 'presence';
+	[key: string]: unknown;
+};
@@ -1,6 +1,7 @@
 import ws from 'k6/ws';
 import { check, sleep } from 'k6';
 import { Counter, Trend } from 'k6/metrics';
+import { SharedArray } from 'k6/data';
 
 // Custom metrics
 const messagesSent = new Counter('messages_sent');
@@ -11,6 +12,12 @@ const messageLatency = new Trend('message_latency');
 const WEBSOCKET_URL = __ENV.WS_URL || 'ws://localhost:8000/ws';
 const ROOM_LIST = ['general', 'python', 'devops', 'random'];
 
+// Optional pre-provisioned users from the auth service's POST /users/bulk.
+// When set, each VU connects with its own token instead of an anonymous name.
+const PROVISIONED_USERS = __ENV.TOKENS_FILE
+  ? new SharedArray('users', () => JSON.parse(open(__ENV.TOKENS_FILE)).users)
+  : [];
+
 // Scenario selection via environment variable
 const SCENARIO = __ENV.SCENARIO || 'baseline';
 
@@ -87,12 +94,19 @@ export const options = {
 };
 
 export default function () {
-  const userId = `user_${__VU}_${Date.now()}`;
+  const account = PROVISIONED_USERS.length
+    ? PROVISIONED_USERS[(__VU - 1) % PROVISIONED_USERS.length]
+    : null;
+  const userId = account ? `${account.username}_${Date.now()}` : `user_${__VU}_${Date.now()}`;
   const room = ROOM_LIST[Math.floor(Math.random() * ROOM_LIST.length)];
   
   // Backend expects /ws/{client_id} format
   const url = `${WEBSOCKET_URL}/${userId}`;
-  const params = { tags: { scenario: SCENARIO, room: room } };
+  // Header rather than ?token= so tokens stay out of access logs
+  const params = {
+    tags: { scenario: SCENARIO, room: room },
+    headers: account ? { Authorization: `Bearer ${account.access_token}` } : {},
+  };
   
   const res = ws.connect(url, params, function (socket) {
     let messageCount = 0;